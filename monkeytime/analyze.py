@@ -1,22 +1,42 @@
 #from gevent import monkey
 #from gevent.pool import Pool
 #import gevent
-#import redis
 #monkey.patch_all()
 from StringIO import StringIO
+from array import array
+from collections import deque
+from datetime import datetime
 from dateutil.parser import parse
 from itertools import count
+from itertools import groupby
 from melk.util.dibject import Dibject as dibj
+from monkeytime import binlog
+from monkeytime.histogram import KeyedHistograms
+from monkeytime.histogram import LatencyHistogram
+from monkeytime.logreader import LogReader
+from monkeytime.logreader import chunk_ranges
+from operator import attrgetter
 from operator import itemgetter
 from path import path
-from statlib import stats
+import calendar
 import csv
+import heapq
 import json
+import mmap
+import multiprocessing
 import optparse
+import os
+import re
+import struct
 import sys
 import time
 import traceback
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 get0 = itemgetter(0)
 
 
@@ -27,6 +47,73 @@ def format_tb():
     return handle.getvalue()
 
 
+class TimestampParser(object):
+    """
+    Strict parser for the fixed timestamp formats written to the logs
+    (2011-05-03T12:34:56.123456, 20110503123456 and the like).
+
+    Timestamps repeat to the second, so datetimes (and epoch seconds,
+    see `epoch`) are cached by their whole-second prefix. Anything that
+    doesn't match exactly is handed to dateutil.
+    """
+    pattern = re.compile(r'(\d{4})-?(\d\d)-?(\d\d)[T_]?(\d\d):?(\d\d):?(\d\d)(?:[.,](\d{1,6})\d*)?$')
+
+    def __init__(self, cache_size=4096, fallback=parse):
+        self.cache = {}
+        self.epochs = {}
+        self.cache_size = cache_size
+        self.fallback = fallback
+        self.prefix = 19
+
+    def __call__(self, timestamp):
+        prefix = self.prefix
+        dt = self.cache.get(timestamp[:prefix])
+        if dt is not None:
+            rest = timestamp[prefix:]
+            if not rest:
+                return dt
+            if rest[0] in '.,' and rest[1:].isdigit():
+                return dt.replace(microsecond=int(rest[1:7].ljust(6, '0')))
+
+        match = self.pattern.match(timestamp)
+        if match is None:
+            return self.fallback(timestamp)
+
+        year, month, day, hour, minute, second, frac = match.groups()
+        dt = datetime(int(year), int(month), int(day),
+                      int(hour), int(minute), int(second))
+        if len(self.cache) >= self.cache_size:
+            self.cache.clear()
+        self.prefix = match.end(6)
+        self.cache[timestamp[:self.prefix]] = dt
+        if frac:
+            dt = dt.replace(microsecond=int(frac.ljust(6, '0')))
+        return dt
+
+    def epoch(self, timestamp):
+        """
+        Seconds since the epoch, reading the timestamp as UTC (as
+        bucket_floor does), without building a datetime on a cache hit
+        """
+        secs = self.epochs.get(timestamp[:self.prefix])
+        if secs is not None:
+            rest = timestamp[self.prefix:]
+            if not rest:
+                return secs
+            if rest[0] in '.,' and rest[1:].isdigit():
+                return secs + int(rest[1:7].ljust(6, '0')) / 1e6
+
+        dt = self(timestamp)
+        secs = calendar.timegm(dt.timetuple())
+        if self.pattern.match(timestamp) is not None:
+            if len(self.epochs) >= self.cache_size:
+                self.epochs.clear()
+            self.epochs[timestamp[:self.prefix]] = secs
+        return secs + dt.microsecond / 1e6
+
+parse_timestamp = TimestampParser()
+
+
 def perf_parse_options(argv=None, usage="usage: %prog [options] dir"):
     parser = optparse.OptionParser(usage=usage)
 
@@ -44,6 +131,115 @@ def perf_parse_options(argv=None, usage="usage: %prog [options] dir"):
                       default=10000
                       )
 
+    parser.add_option('-i', '--interval',
+                      type="int",
+                      help='Seconds per statistics interval',
+                      dest='interval',
+                      default=60
+                      )
+
+    parser.add_option('-w', '--workers',
+                      type="int",
+                      help='Parse log files in this many processes',
+                      dest='workers',
+                      default=None
+                      )
+
+    parser.add_option('-p', '--pattern',
+                      help='Glob for log files',
+                      dest='pattern',
+                      default='perf.log*'
+                      )
+
+    parser.add_option('-b', '--by',
+                      help='Break intervals down by one of: %s' %", ".join(sorted(group_keys)),
+                      dest='by',
+                      default=None
+                      )
+
+    parser.add_option('-k', '--top',
+                      type="int",
+                      help='Most keys to keep per interval when using --by',
+                      dest='top',
+                      default=100
+                      )
+
+    parser.add_option('--window',
+                      type="int",
+                      help='Intervals covered by each live row',
+                      dest='window',
+                      default=1
+                      )
+
+    parser.add_option('--span',
+                      type="int",
+                      help='Seconds a request tree stays open for late records',
+                      dest='span',
+                      default=300
+                      )
+
+    parser.add_option('-s', '--store',
+                      help='Rollup store to update and query',
+                      dest='store',
+                      default='perf.rollup'
+                      )
+
+    parser.add_option('-r', '--resolution',
+                      type="int",
+                      help='Seconds per bucket in a new rollup store',
+                      dest='resolution',
+                      default=None
+                      )
+
+    parser.add_option('--index',
+                      help='Request index: an sqlite file or redis://host:port/db',
+                      dest='index',
+                      default='perf.index'
+                      )
+
+    parser.add_option('--slowest',
+                      help='Show the slowest indexed requests for this uri',
+                      dest='slowest',
+                      default=None
+                      )
+
+    parser.add_option('--origin',
+                      help='Show every indexed request made for this origin uid',
+                      dest='origin',
+                      default=None
+                      )
+
+    parser.add_option('--after',
+                      help='Only requests logged from this timestamp on',
+                      dest='after',
+                      default=None
+                      )
+
+    parser.add_option('--before',
+                      help='Only requests logged before this timestamp',
+                      dest='before',
+                      default=None
+                      )
+
+    parser.add_option('--vectorize',
+                      action="store_true",
+                      help='Read lines into columns and bucket and summarize them with NumPy (faster, exact percentiles)',
+                      dest='vectorize',
+                      default=False
+                      )
+
+    parser.add_option('--columns',
+                      help='Also write the statistics as .npy columns to this directory',
+                      dest='columns',
+                      default=None
+                      )
+
+    parser.add_option('-o', '--outfile',
+                      help='File to write results to',
+                      dest='outfile',
+                      default='perf.csv'
+                      )
+
     if argv is None:
         argv = sys.argv
     options, args = parser.parse_args(argv)
@@ -55,49 +251,206 @@ def perf_parse_options(argv=None, usage="usage: %prog [options] dir"):
     return options, args[1]
 
 
-class PerfInfo(dibj):
+class PerfInfo(object):
     """
-    Performance info object
+    Performance info for a single log line
     """
+    __slots__ = fields = ('line', 'pid', 'timestamp', 'inout', 'lineage',
+                          'howlong', 'uri', 'status', 'dt', 'origin',
+                          'parent', 'uid', 'old', 'clock')
+
+    def __init__(self, **kw):
+        for field in self.fields:
+            setattr(self, field, kw.get(field))
+
     @classmethod
-    def from_line(cls, line):
-        return cls(**cls.parse_line(line))
-        
-    def __str__(self):
-        return self.line
+    def from_line(cls, line, parse_ts=parse_timestamp):
+        """
+        Split a log line into its fields:
+
+            pid timestamp inout origin:parent:uid howlong uri [status]
 
-    @staticmethod
-    def parse_line(line):
-        #pid, timestamp, inout, lineage, howlong, uri, status = line.split()
+        Lines without a status are from the old format and are marked
+        'old'. Raises ValueError on anything else.
+        """
         ele = line.split()
-        if len(ele) == 6:
-            pid, timestamp, inout, lineage, howlong, uri = ele
-            old = True
+        nele = len(ele)
+        self = cls.__new__(cls)
+        self.clock = None
+        if nele == 7:
+            self.status = int(ele[6])
+            self.old = None
+        elif nele == 6:
+            self.status = None
+            self.old = True
         else:
-            pid, timestamp, inout, lineage, howlong, uri, status = ele
-            status = int(status)
-        howlong = float(howlong)
-        dt = parse(timestamp)
-        origin, parent, uid = lineage.split(":")
-        return locals()
+            raise ValueError("Expected 6 or 7 fields, got %d" %nele)
+        self.line = line
+        self.pid, self.timestamp, self.inout, self.lineage = ele[:4]
+        self.howlong = float(ele[4])
+        self.uri = ele[5]
+        self.dt = parse_ts(self.timestamp)
+        self.origin, self.parent, self.uid = self.lineage.split(":")
+        return self
+
+    @classmethod
+    def from_record(cls, record):
+        """
+        From a decoded binary trace record (see binlog.unpack_from)
+        """
+        pid, start, wall, clock, status, logname, origin, parent, uid, uri = record
+        self = cls.__new__(cls)
+        self.line = self.old = None
+        self.pid = str(pid)
+        self.dt = datetime.fromtimestamp(start)
+        self.timestamp = self.dt.isoformat()
+        self.inout = "[%s]" %logname
+        self.origin, self.parent, self.uid = origin, parent, uid
+        self.lineage = "%s:%s:%s" %(origin, parent, uid)
+        self.howlong = wall
+        self.clock = clock
+        self.uri = uri
+        self.status = status
+        return self
+
+    @classmethod
+    def parse_line(cls, line, parse_ts=parse_timestamp):
+        return cls.from_line(line, parse_ts).as_dict()
+
+    def __str__(self):
+        return self.line or "%s %s %s %s %f %s %s" %(self.pid, self.timestamp, self.inout,
+                                                      self.lineage, self.howlong,
+                                                      self.uri, self.status)
+
+    def get(self, key, default=None):
+        return getattr(self, key, default)
+
+    def __getitem__(self, key):
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        setattr(self, key, value)
+
+    def items(self):
+        return [(field, getattr(self, field)) for field in self.fields
+                if getattr(self, field) is not None]
+
+    def as_dict(self):
+        return dict(self.items())
+
+    def to_json(self):
+        jsonable = self.as_dict()
+        del jsonable['dt']
+        return json.dumps(jsonable)
+
+
+class PerfBatch(object):
+    """
+    Columnar batch of parsed lines for vectorized consumers: durations
+    and epoch times (UTC, as bucket_floor) in arrays of doubles, and
+    each line's group key (see group_key) as an int code into `keys`,
+    so a key (a uri, say) is kept once per batch rather than per line.
+    """
+
+    def __init__(self):
+        self.howlong = array('d')
+        self.epoch = array('d')
+        self.key = array('i')
+        self.keys = []
+        self.codes = {}
+
+    def __len__(self):
+        return len(self.howlong)
+
+    def code(self, key):
+        code = self.codes.get(key)
+        if code is None:
+            code = self.codes[key] = len(self.keys)
+            self.keys.append(key)
+        return code
+
+    def append(self, howlong, epoch, key=None):
+        self.howlong.append(howlong)
+        self.epoch.append(epoch)
+        self.key.append(self.code(key))
+
+
+class BinaryLogReader(object):
+    """
+    PerfInfo records decoded from a memory mapped binary trace log
+    (see monkeytime.binlog), with the same interface as LogReader.
+    `start` must be a record boundary, such as a previous `offset`.
+    """
+
+    def __init__(self, filename, start=0, end=None, whole_lines=False):
+        self.filename = filename
+        self.start = start
+        self.end = end
+        self.offset = start
+        self.lines = 0
+
+    def __iter__(self):
+        with open(self.filename, 'rb') as fh:
+            size = os.fstat(fh.fileno()).st_size
+            end = size
+            if self.end is not None:
+                end = min(self.end, size)
+            if self.start >= end:
+                return
+            mm = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                offset = self.start
+                from_record = PerfInfo.from_record
+                while offset < end:
+                    record, offset = binlog.unpack_from(mm, offset)
+                    if record is None:
+                        break
+                    self.offset = offset
+                    self.lines += 1
+                    yield from_record(record)
+            finally:
+                mm.close()
+
+
+def open_log(logfile, start=0, end=None, whole_lines=False):
+    """
+    Reader for a text or binary log file
+    """
+    reader = LogReader
+    if os.path.getsize(logfile) and binlog.is_binary(logfile):
+        reader = BinaryLogReader
+    return reader(logfile, start, end, whole_lines)
+
 
 ## for logfile in path.files(pattern):
 ##     pool.spawn(load(logfile.lines))
 
-def generate_perf_info(lines, marker=None, **filters):
+def generate_perf_info(lines, marker=None, serialize=False, **filters):
     """
+    `lines` may be any iterable of lines or already decoded PerfInfos
+    (a LogReader or BinaryLogReader streams a file without loading it).
+
+    Yields (uid, PerfInfo, json) tuples; json is only produced when
+    `serialize` is set, otherwise it is None.
+
     Marker signal, useful when filtration removes all
     entries
     """
     counter = count()
     filtered = count()
     returned = count()
-    print "Total: %s" %len(lines)
+    total = count()
     for line in lines:
-        line = line.strip()
+        next(total)
+        decoded = type(line) is PerfInfo
+        if not decoded:
+            line = line.strip()
         if line:
             try:
-                perfinfo = PerfInfo.from_line(line)
+                perfinfo = decoded and line or PerfInfo.from_line(line)
                 if perfinfo.get('old'):
                     next(counter)
                     continue
@@ -113,15 +466,16 @@ def generate_perf_info(lines, marker=None, **filters):
                 if not use:
                     continue
 
-                jsonable = perfinfo.copy()
-                perfinfo['dt'] = jsonable.pop('dt')
-                serialized = json.dumps(jsonable)
+                serialized = None
+                if serialize:
+                    serialized = perfinfo.to_json()
                 next(returned)
                 yield perfinfo.uid, perfinfo, serialized
             except ValueError, e:
                 print "Parse error: %s" %e
                 print line
                 
+    print "Total: %s" %total
     print "Returned: %s" %returned
     if not next(returned):
         yield marker, marker, marker
@@ -130,113 +484,643 @@ def generate_perf_info(lines, marker=None, **filters):
 
 
 
-def groups(lines, interval, **filters):
-    group = []
-    currtime = None
-    start = None
+def perf_batches(lines, size=10000, by=None, **filters):
+    """
+    Parsed (and filtered) lines as PerfBatches of up to `size` records,
+    keyed by `by` (see group_key).
+
+    Unfiltered text lines keyed by name (or not at all) are split
+    straight into the columns (see line_batches); anything else goes
+    through generate_perf_info and a PerfInfo per line.
+    """
+    if not filters and not callable(by) and not isinstance(lines, BinaryLogReader):
+        return line_batches(lines, size, by)
+    return info_batches(lines, size, by, **filters)
+
+
+def info_batches(lines, size=10000, by=None, **filters):
+    keyfunc = group_key(by)
+    batch = PerfBatch()
     marker = object()
     for uid, info, blob in generate_perf_info(lines, marker=marker, **filters):
-        if uid is marker: # got nothing
+        if uid is marker:
             break
+        dt = info.dt
+        batch.append(info.howlong, calendar.timegm(dt.timetuple()) + dt.microsecond / 1e6,
+                     keyfunc and keyfunc(info))
+        if len(batch) >= size:
+            yield batch
+            batch = PerfBatch()
+    if len(batch):
+        yield batch
+
+
+def line_batches(lines, size=10000, by=None, parse_epoch=parse_timestamp.epoch):
+    """
+    PerfBatches of text log lines, checked and skipped as in
+    generate_perf_info (old and malformed lines are left out) but
+    without a PerfInfo per line. `by` must be a name from line_keys.
+    """
+    keyfunc = None
+    if by is not None:
+        try:
+            keyfunc = line_keys[by]
+        except KeyError:
+            raise ValueError("Unknown group key %r, expected one of %s" %(by, ", ".join(sorted(line_keys))))
+    total = returned = old = 0
+    batch = None
+    for line in lines:
+        if batch is None:
+            batch = PerfBatch()
+            howlongs, epochs, keys = batch.howlong.append, batch.epoch.append, batch.key.append
+            codes = batch.codes
+            if keyfunc is None:
+                batch.code(None)
+        total += 1
+        ele = line.split()
+        nele = len(ele)
+        if nele != 7:
+            if nele == 6:
+                old += 1
+            elif nele:
+                print "Parse error: Expected 6 or 7 fields, got %d" %nele
+                print line.strip()
+            continue
+        try:
+            howlong = float(ele[4])
+            int(ele[6])
+            epoch = parse_epoch(ele[1])
+            if ele[3].count(":") != 2:
+                raise ValueError("Expected origin:parent:uid, got %r" %ele[3])
+        except ValueError, e:
+            print "Parse error: %s" %e
+            print line.strip()
+            continue
+        howlongs(howlong)
+        epochs(epoch)
+        if keyfunc is None:
+            keys(0)
+        else:
+            key = keyfunc(ele)
+            code = codes.get(key)
+            if code is None:
+                code = batch.code(key)
+            keys(code)
+        returned += 1
+        if len(batch) >= size:
+            yield batch
+            batch = None
+    if batch is not None and len(batch):
+        yield batch
+    print "Total: %s" %total
+    print "Returned: %s" %returned
+    print "Old: %s" %old
+
+
+def bucket_floor(dt, interval):
+    """
+    Epoch second (on the log's own clock) at which the fixed,
+    `interval` second bucket containing `dt` (a datetime, or epoch
+    seconds already) starts
+    """
+    epoch = dt
+    if isinstance(dt, datetime):
+        epoch = calendar.timegm(dt.timetuple())
+    return epoch - epoch % interval
+
+
+def epoch_timestamp(epoch):
+    return datetime.utcfromtimestamp(epoch).strftime("%Y-%m-%dT%H:%M:%S")
+
+
+def uri_prefix(info):
+    return "/" + info.uri.lstrip("/").split("/", 1)[0]
+
+
+def status_class(info):
+    if info.status is None:
+        return None
+    return "%dxx" %(info.status // 100)
+
+
+group_keys = dict(uri=attrgetter('uri'),
+                  uri_prefix=uri_prefix,
+                  status_class=status_class,
+                  inout=attrgetter('inout'),
+                  pid=attrgetter('pid'))
+
+
+def line_uri_prefix(ele):
+    return "/" + ele[5].lstrip("/").split("/", 1)[0]
+
+
+def line_status_class(ele):
+    return "%dxx" %(int(ele[6]) // 100)
+
 
-        if currtime is None:
-            currtime = info.dt
-            start = info.timestamp
+# group_keys for the split fields of a log line (see line_batches)
+line_keys = dict(uri=itemgetter(5),
+                 uri_prefix=line_uri_prefix,
+                 status_class=line_status_class,
+                 inout=itemgetter(2),
+                 pid=itemgetter(0))
 
-        group.append(info)
-        depth = (info.dt - currtime).seconds
 
-        if interval < depth:
-            currtime = None
-            out = group[:]
-            group = []
-            yield out, start
+def group_key(by):
+    """
+    Resolve `by` (a name from group_keys, a callable or None) to a
+    function of a PerfInfo
+    """
+    if by is None:
+        return None
+    if callable(by):
+        return by
+    try:
+        return group_keys[by]
+    except KeyError:
+        raise ValueError("Unknown group key %r, expected one of %s" %(by, ", ".join(sorted(group_keys))))
+
+
+def groups(lines, interval, by=None, top=None, reorder=5, **filters):
+    """
+    Bucket durations into fixed `interval` second KeyedHistograms,
+    aligned to the epoch (see bucket_floor), yielding (histograms,
+    start) as each bucket closes. Buckets from different files or
+    workers with the same start cover the same span, so they can be
+    merged (see merge_streams).
+
+    by
+
+       group key (see group_keys) to break each interval down by; all
+       durations share the key None if not given
+
+    top
+
+       most keys kept per interval, the rest are lumped together
+
+    reorder
+
+       seconds past its end a bucket is held open for out of order
+       lines; a line later than that opens a fresh, partial bucket
+       with the same start
+    """
+    keyfunc = group_key(by)
+    buckets = {}
+    latest = None
+    marker = object()
+    for uid, info, blob in generate_perf_info(lines, marker=marker, **filters):
+        if uid is marker: # got nothing
+            break
+
+        epoch = calendar.timegm(info.dt.timetuple())
+        start = bucket_floor(epoch, interval)
+        hists = buckets.get(start)
+        if hists is None:
+            hists = buckets[start] = KeyedHistograms(top)
+        hists.add(keyfunc and keyfunc(info), info.howlong)
+
+        if epoch > latest:
+            latest = epoch
+            for then in sorted(x for x in buckets if x + interval + reorder <= latest):
+                yield buckets.pop(then), epoch_timestamp(then)
 
     # yield whatever is left
-    yield group, start
+    for then in sorted(buckets):
+        yield buckets[then], epoch_timestamp(then)
+
 
-        
 def statdict(times, start, interval):
-    standard_deviation = 0
-    if len(times) > 1:
-        standard_deviation = stats.lstdev(times)
+    """
+    Summarize a LatencyHistogram (or any iterable of durations)
+    """
+    hist = times
+    if not isinstance(times, LatencyHistogram):
+        hist = LatencyHistogram.from_values(times)
     return dibj(interval=interval,
                 start=start,
-                max=max(times) * 1000,
-                min=min(times) * 1000,
-                mean=stats.lmean(times) * 1000,
-                median=stats.lmedianscore(times) * 1000,
-                p90th=abs(stats.lscoreatpercentile(times, 0.9)) * 1000,
-                p98th=abs(stats.lscoreatpercentile(times, 0.98)) * 1000,
-                p99th=abs(stats.lscoreatpercentile(times, 0.99)) * 1000,
-                standard_deviation=standard_deviation * 1000,
-                howmany=len(times))
+                max=hist.max * 1000,
+                min=hist.min * 1000,
+                mean=hist.mean * 1000,
+                median=hist.median * 1000,
+                p90th=hist.percentile(0.9) * 1000,
+                p98th=hist.percentile(0.98) * 1000,
+                p99th=hist.percentile(0.99) * 1000,
+                standard_deviation=hist.stdev * 1000,
+                howmany=hist.count)
 
 
 def ext2int(ext):
     nada, ext = ext.split('.')
-    if ext == 'log':
+    if not ext.isdigit():
         return 0
     return int(ext)
 
-def yield_stats(logdir, pattern="perf.log", interval=60, **filters):
-
+def log_files(logdir, pattern="perf.log"):
+    """
+    Rotated log files in `logdir`, oldest first
+    """
     files = logdir.files(pattern)
 
     print "%d files" %len(files)
     
     files = sorted(((ext2int(x.ext), x) for x in files if not x.endswith('~')), key=get0, reverse=True)
-    files = [y for x, y in files]
-    last = None
+    return [y for x, y in files]
+
+
+def iter_file_stats(logfile, interval, start=0, end=None, **filters):
+    """
+    Partial aggregates for a log file, or the lines starting in its
+    byte range [start, end): (start, KeyedHistograms) in file order
+    """
+    print "File: %s" %logfile
+    for hists, then in groups(open_log(logfile, start, end), interval, **filters):
+        if hists.count:
+            yield then, hists
+
+
+def file_stats(logfile, interval, start=0, end=None, **filters):
+    return list(iter_file_stats(logfile, interval, start, end, **filters))
+
+
+def _file_stats_job(args):
+    stats, logfile, start, end, interval, filters = args
+    return list(stats(logfile, interval, start, end, **filters))
+
+
+def merge_streams(streams, hold=2):
+    """
+    Streaming k-way merge of time ordered (start, KeyedHistograms)
+    streams, such as one iter_file_stats per file. Partials sharing a
+    start are combined; the latest `hold` starts are held back so
+    partials for lines that arrived late (see groups) still join
+    them. Memory depends on `hold`, not on the length of the streams.
+    """
+    def tagged(num, stream):
+        for start, hists in stream:
+            yield start, num, hists
+
+    pending = {}
+    merged = heapq.merge(*[tagged(num, stream) for num, stream in enumerate(streams)])
+    for start, rows in groupby(merged, key=get0):
+        hists = pending.get(start)
+        for then, num, partial in rows:
+            if hists is None:
+                hists = pending[start] = partial
+            else:
+                hists.merge(partial)
+        while len(pending) > hold:
+            oldest = min(pending)
+            yield oldest, pending.pop(oldest)
+    for start in sorted(pending):
+        yield start, pending[start]
+
+
+def interval_stats(hists, start, interval, by=None):
+    """
+    statdicts for each key of an interval's KeyedHistograms
+    """
+    for key, hist in hists.items():
+        if not hist.count:
+            continue
+        info = statdict(hist, start, interval)
+        if by is not None:
+            info['key'] = key
+        yield info
+
+
+def parallel_file_stats(files, interval, workers, chunk_bytes=64 * 1024 * 1024, ahead=2,
+                        stats=iter_file_stats, **filters):
+    """
+    Bucket each file, or each `chunk_bytes` piece of large text logs,
+    in a pool of `workers` processes, yielding each piece's partial
+    aggregates in file order (oldest file first) for merge_streams. At
+    most `ahead` pieces per worker are in flight or waiting to be
+    consumed, so memory doesn't grow with the logs. `stats` buckets
+    each piece (iter_file_stats or vectorized.iter_file_stats).
+
+    Filters are shipped to the workers, so they must be picklable
+    (module level functions rather than lambdas).
+    """
+    jobs = []
     for logfile in files:
-        lines = logfile.lines()
-        print "File: %s" %logfile
-        for i, (rawgroup, start) in enumerate(groups(lines, interval, **filters)):
-            if not start:
-                continue
-            time = parse(start)
-            if not i % 100:
-                print time.strftime("%Y-%m-%dT%H:%M:%SZ")
-            if last is None:
-                last = time
-                print "New start: %s" %start
-            if  last > time:
-                print "timewarp: %s %s" %(last.strftime("%Y-%m-%dT%H:%M:%SZ"), time.strftime("%Y-%m-%dT%H:%M:%SZ"))
-                last = None
+        if os.path.getsize(logfile) and binlog.is_binary(logfile):
+            # binary records can only be read from a record boundary
+            jobs.append((stats, logfile, 0, None, interval, filters))
+            continue
+        jobs.extend((stats, logfile, start, end, interval, filters)
+                    for start, end in chunk_ranges(logfile, chunk_bytes))
 
-            try:
-                times = [x.howlong for x in rawgroup]
-                if not times:
-                    continue
-                yield statdict(times, start, interval)
-            except Exception:
-                print format_tb()
+    pool = multiprocessing.Pool(workers)
+    try:
+        running = deque()
+        for job in jobs:
+            running.append(pool.apply_async(_file_stats_job, (job,)))
+            if len(running) > workers * ahead:
+                for partial in running.popleft().get():
+                    yield partial
+        while running:
+            for partial in running.popleft().get():
+                yield partial
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def yield_stats(logdir, pattern="perf.log", interval=60, workers=None,
+                by=None, top=None, vectorize=False, **filters):
+    """
+    Interval statistics for the rotated logs in `logdir`. With `by`,
+    one row per key per interval (see groups) carrying a 'key' field.
+
+    With `vectorize`, lines are read into PerfBatches and bucketed and
+    summarized with NumPy (see monkeytime.vectorized): exact
+    percentiles, the same intervals and keys.
+    """
+    files = log_files(logdir, pattern)
+    stats = iter_file_stats
+    summarize = interval_stats
+    if vectorize:
+        from monkeytime import vectorized
+        stats = vectorized.iter_file_stats
+        summarize = vectorized.interval_stats
 
+    if workers and workers > 1:
+        merged = merge_streams([parallel_file_stats(files, interval, workers, stats=stats,
+                                                    by=by, top=top, **filters)])
+    else:
+        merged = merge_streams([stats(logfile, interval, by=by, top=top, **filters)
+                                for logfile in files])
 
-def stats_to_csv(outfile, logdir, interval, **filters):
+    for start, hists in merged:
+        try:
+            for info in summarize(hists, start, interval, by):
+                yield info
+        except Exception:
+            # one bad interval shouldn't cost the rest of the run
+            print format_tb()
+
+
+def stats_to_csv(outfile, logdir, interval, pattern="perf.log", workers=None,
+                 by=None, top=None, columns=None, vectorize=False, **filters):
+    """
+    Write interval statistics to `outfile` row by row as they are
+    produced (in time order) and, given a `columns` directory, as
+    columns there too (see ColumnWriter). Returns the row counter.
+    """
     counter = count()
 
-    statg = yield_stats(logdir, interval=interval, **filters)
-    try:
-        first = next(statg)
-    except StopIteration:
-        return counter
-        
-    fields = sorted(first)
-    #print ",".join(fields)
-    outfile.write_lines([",".join(fields)])
-    writer = csv.DictWriter(open(outfile, 'a'), fields)
-    
-    for statinfo in sorted(statg, key=itemgetter('start')):
-        next(counter)
-        writer.writerow(statinfo)
+    statg = yield_stats(logdir, pattern=pattern, interval=interval, workers=workers,
+                        by=by, top=top, vectorize=vectorize, **filters)
+    fields = None
+    sink = columns and ColumnWriter(columns) or None
+    with open(outfile, 'w') as out:
+        for statinfo in statg:
+            if fields is None:
+                fields = sorted(statinfo)
+                out.write(",".join(fields) + "\n")
+                writer = csv.DictWriter(out, fields)
+            writer.writerow(statinfo)
+            if sink is not None:
+                sink.append(statinfo)
+            next(counter)
+    if sink is not None:
+        sink.close()
     return counter
 
 
+class ColumnWriter(object):
+    """
+    Rows written to `directory` as one .npy file of doubles per field
+    ('start' as epoch seconds), for numpy.load(..., mmap_mode='r') or
+    load_column. Text fields (the 'key' of --by) go to <field>.txt, a
+    line per row. Rows are appended as they come and only the header
+    is rewritten at close, so memory stays constant however long the
+    series.
+    """
+    header_size = 128
+    buffer_rows = 4096
+
+    def __init__(self, directory):
+        self.directory = path(directory)
+        self.directory.makedirs_p()
+        self.files = {}
+        self.buffers = {}
+        self.text = {}
+        self.rows = 0
+
+    def npy_header(self):
+        header = "{'descr': '<f8', 'fortran_order': False, 'shape': (%d,), }" %self.rows
+        header = header.ljust(self.header_size - 11) + "\n"
+        return "\x93NUMPY\x01\x00" + struct.pack('<H', len(header)) + header
+
+    def start(self, row):
+        for name, value in row.iteritems():
+            if name == 'key' or name != 'start' and isinstance(value, basestring):
+                self.text[name] = open(self.directory / ("%s.txt" %name), 'w')
+            else:
+                fh = self.files[name] = open(self.directory / ("%s.npy" %name), 'wb')
+                fh.write(self.npy_header())
+                self.buffers[name] = array('d')
+
+    def append(self, row):
+        if not self.files and not self.text:
+            self.start(row)
+        for name, buf in self.buffers.iteritems():
+            value = row.get(name)
+            if name == 'start':
+                value = calendar.timegm(parse_timestamp(value).timetuple())
+            buf.append(value is None and float('nan') or value)
+        for name, fh in self.text.iteritems():
+            fh.write("%s\n" %row.get(name))
+        self.rows += 1
+        if not self.rows % self.buffer_rows:
+            self.flush()
+
+    def flush(self):
+        for name, buf in self.buffers.iteritems():
+            buf.tofile(self.files[name])
+            del buf[:]
+
+    def close(self):
+        self.flush()
+        header = self.npy_header()
+        for fh in self.files.itervalues():
+            fh.seek(0)
+            fh.write(header)
+            fh.close()
+        for fh in self.text.itervalues():
+            fh.close()
+
+
+def load_column(filename, mmap=True):
+    """
+    A column written by ColumnWriter: a (memory mapped) NumPy array if
+    NumPy is installed, else an array of doubles. .txt columns load as
+    a list of strings.
+    """
+    filename = path(filename)
+    if filename.ext == '.txt':
+        return filename.lines(retain=False)
+    if numpy is not None:
+        return numpy.load(filename, mmap_mode=mmap and 'r' or None)
+    with open(filename, 'rb') as fh:
+        fh.seek(8)
+        hlen, = struct.unpack('<H', fh.read(2))
+        fh.seek(10 + hlen)
+        column = array('d')
+        column.fromstring(fh.read())
+    return column
+
+
+def csv_main(argv=None):
+    """
+    Write interval statistics for a log directory to a csv file
+    """
+    options, logdir = perf_parse_options(argv)
+    counter = stats_to_csv(path(options.outfile), logdir, options.interval,
+                           pattern=options.pattern, workers=options.workers,
+                           by=options.by, top=options.top, columns=options.columns,
+                           vectorize=options.vectorize)
+    print "%s rows written to %s" %(counter, options.outfile)
+
+
+def rollup_main(argv=None):
+    """
+    Bring a rollup store up to date with a log directory and write its
+    statistics at --interval to a csv file
+    """
+    from monkeytime.rollup import RollupStore
+    options, logdir = perf_parse_options(argv)
+    store = RollupStore(options.store, options.resolution, by=options.by, top=options.top)
+    try:
+        print "%d new lines" %store.update(logdir, options.pattern)
+        fields = None
+        with open(options.outfile, 'w') as out:
+            for i, statinfo in enumerate(store.stats(options.interval)):
+                if fields is None:
+                    fields = sorted(statinfo)
+                    out.write(",".join(fields) + "\n")
+                    writer = csv.DictWriter(out, fields)
+                writer.writerow(statinfo)
+        print "%d rows written to %s" %(fields and i + 1 or 0, options.outfile)
+    finally:
+        store.close()
+
+
+def follow_main(argv=None):
+    """
+    Tail the active log, writing csv rows to stdout as intervals close
+    """
+    from monkeytime.follow import LogFollower, follow_stats
+    options, logdir = perf_parse_options(argv)
+    rows = follow_stats(LogFollower(logdir), options.interval, options.window,
+                        by=options.by, top=options.top)
+    fields = None
+    try:
+        for statinfo in rows:
+            if fields is None:
+                fields = sorted(statinfo)
+                sys.stdout.write(",".join(fields) + "\n")
+                writer = csv.DictWriter(sys.stdout, fields)
+            writer.writerow(statinfo)
+            sys.stdout.flush()
+    except KeyboardInterrupt:
+        pass
+
+
+def traces_main(argv=None):
+    """
+    Join the logs of every service into request trees and write the
+    critical path report (see traces.CriticalPathReport) to a csv file
+    """
+    from monkeytime.traces import CriticalPathReport, trace_trees
+    options, logdir = perf_parse_options(argv)
+    report = CriticalPathReport(options.top)
+    for tree in trace_trees(logdir, options.pattern, options.span):
+        report.add(tree)
+    fields = ['uri', 'traces', 'mean', 'p99th', 'contributor', 'calls',
+              'contributor_mean', 'share']
+    with open(options.outfile, 'w') as out:
+        out.write(",".join(fields) + "\n")
+        writer = csv.DictWriter(out, fields)
+        for row in report.rows():
+            writer.writerow(row)
+    print "%d trees, %d without a root" %(report.latency.count + report.orphans, report.orphans)
+    print "Report written to %s" %options.outfile
+
+
+def index_main(argv=None):
+    """
+    Add a log directory to the request index (unless --noload), then
+    write the --slowest requests for a uri or the requests for an
+    --origin to a csv file
+    """
+    from monkeytime.index import fields, open_index
+    from monkeytime.traces import epoch
+    options, logdir = perf_parse_options(argv)
+    index = open_index(options.index)
+    try:
+        if options.load:
+            read, new = index.update(logdir, options.pattern)
+            print "%d lines read, %d new requests indexed" %(read, new)
+        rows = []
+        if options.slowest:
+            after = options.after and epoch(parse_timestamp(options.after))
+            before = options.before and epoch(parse_timestamp(options.before))
+            rows = index.slowest(options.slowest, after, before)
+        elif options.origin:
+            rows = index.children(options.origin)
+        if options.slowest or options.origin:
+            with open(options.outfile, 'w') as out:
+                out.write(",".join(fields) + "\n")
+                csv.DictWriter(out, fields).writerows(rows)
+            print "%d rows written to %s" %(len(rows), options.outfile)
+    finally:
+        index.close()
+
+
+def shm_main(argv=None):
+    """
+    Print the merged percentiles of a shared histogram region (see
+    monkeytime.shm) as json
+    """
+    from monkeytime.shm import SharedHistograms
+    options, region = perf_parse_options(argv, usage="usage: %prog [options] region")
+    if not region.isfile():
+        print "No shared histogram region at %s" %region
+        return 1
+    shared = SharedHistograms(region)
+    try:
+        print json.dumps(shared.summary(), indent=2, sort_keys=True)
+    finally:
+        shared.close()
+
+
+commands = dict(csv=csv_main,
+                follow=follow_main,
+                index=index_main,
+                rollup=rollup_main,
+                shm=shm_main,
+                traces=traces_main)
+
+
+def main(argv=None):
+    """
+    monkeytime-analyze <command> [options] dir
+    """
+    if argv is None:
+        argv = sys.argv
+    if len(argv) < 2 or argv[1] not in commands:
+        print "usage: %s {%s} [options] dir" %(path(argv[0]).name, ",".join(sorted(commands)))
+        return 2
+    return commands[argv[1]](argv[:1] + argv[2:])
+
+
 def mkepoch(txt, ms=False):
     dt = txt
     if isinstance(txt, basestring):
-        dt = parse(txt)
+        dt = parse_timestamp(txt)
     epoch = time.mktime(dt.timetuple())
     if ms:
         epoch = epoch * 1000
@@ -249,109 +1133,22 @@ def noop(val):
 
 def c2xy(fp, x, y, xtrans=noop, ytrans=noop, separate=True):
     """
-    cvs to json array
+    x and y columns from a stats csv file or a ColumnWriter directory.
+    Columns load without per row parsing (memory mapped with NumPy),
+    and are only transformed value by value if given xtrans/ytrans.
     """
-    outy, outx = [], []
-    for rowd in csv.DictReader(open(fp)):
-        outy.append(ytrans(rowd[y]))
-        outx.append(xtrans(rowd[x]))
+    fp = path(fp)
+    if fp.isdir():
+        outx, outy = load_column(fp / ("%s.npy" %x)), load_column(fp / ("%s.npy" %y))
+        if xtrans is not noop:
+            outx = [xtrans(val) for val in outx]
+        if ytrans is not noop:
+            outy = [ytrans(val) for val in outy]
+    else:
+        outy, outx = [], []
+        for rowd in csv.DictReader(open(fp)):
+            outy.append(ytrans(rowd[y]))
+            outx.append(xtrans(rowd[x]))
     if separate:
         return outx, outy
     return zip(outx, outy)
-
-
-
-    
-
-
-    
-## def load_perf(argv=None, pattern="perf.log*"):
-##     counter = count()
-##     collision_count = count()
-##     options, path = perf_parse_options(argv)
-##     rdis = redis.Redis("localhost")
-##     collisions = next(collision_count)
-##     inlog = []
-##     outlog = []
-    
-##     for logfile in path.files(pattern):
-##         pipe = rdis.pipeline()
-##         for uid, info, blob in generate_perf_info(logfile.lines()):
-##             i = next(counter)
-##             if info.inout == "[instr.inbound]":
-##                 inlog.append((info.timestamp, info.howlong))
-##             if info.inout == "[instr.outbound]":                
-##                 outlog.append((info.timestamp, info.howlong))
-##             if i == options.howmany:
-##                 break
-##             if not i % 1000 and i > 0:
-##                 print info.timestamp
-##                 pipe.execute()
-##                 pipe = rdis.pipeline()
-##             if options.load == True:
-##                 name = "request:%s" %uid
-##                 if rdis.exists(name):
-##                     collisions = next(collision_count)
-##                     continue
-##                 rload(pipe, uid, name, info)
-##             if not i % 100000:
-##                 print "line: %s" %i
-##         pipe.execute()
-
-##     print "<<< %d lines loaded, %d collisions >>>" %(i, collisions)
-
-
-## def rload(pipe, uid, name, info):
-##     pipe.set(name, info.howlong)
-##     ts = int("".join(info.timestamp.split(":")))
-##     pipe.zadd(info.inout, name, ts)
-##     for key, value in info.items():
-##         pipe.hset("info:%s" %uid, key, value)
-##     if info.origin:
-##         pipe.hset("request:uid->origin", uid, info.origin)
-##     else:
-##         pipe.hset("request:uid->origin", uid, uid)
-##     if info.parent:
-##         pipe.hset("request:uid->parent", uid, info.parent)
-##     origin = info.origin and info.origin or uid
-##     pipe.zadd("request:uri_length", "%s %s" %(info.uri, float(info.howlong)), float(info.howlong))
-##     pipe.zadd("request:uri_ts", "%s %s" %(info.uri, float(info.howlong)), ts)
-##     pipe.zadd("request:ts_length:%s" %info.inout, "%s:%s" %(ts, float(info.howlong)), ts)
-##     pipe.zadd("request:uid", uid, ts)
-##     pipe.zadd("request:logged:origin:%s" %origin, uid, ts)
-##     pipe.zadd("request:logged:parent:%s" %info.parent, uid, ts)
-##     pipe.zadd("request:logged:id:%s" %origin, uid, ts)
-##     pipe.zadd("request:howlong:id:%s" %origin, uid, float(info.howlong))
-##     pipe.zadd("request:howlong:uri:%s" %info.uri, float(info.howlong), float(info.howlong))
-##     pipe.zadd("request:howlong:uids_for_uri:%s" %info.uri, uid, float(info.howlong))
-##     pipe.zadd("request:howlong:origins_for_uri:%s" %info.uri, info.origin, float(info.howlong))
-##     pipe.zadd("request:when:origins_for_uri:%s" %info.uri, info.origin, ts)
-##     if info.inout == "[inbound]":
-##         pipe.hincrby("request:uri_hits", info.uri)
-##         pipe.zincrby("request:uri_hit_set", info.uri)
-
-
- 
-## def analyze(rdis):
-##     in_uids = (x.split(":")[1] for x in rdis.zrange("[instr.inbound]", 0, 10000000))
-##     out_uids = (x.split(":")[1] for x in rdis.zrange("[instr.outbound]", 0, 10000000))
-##     in_names = (x for x in rdis.zrange("[instr.inbound]", 0, 10000000))
-##     out_names = (x for x in rdis.zrange("[instr.outbound]", 0, 10000000))
-##     in_times = [float(rdis.get(x)) for x in in_names]
-##     out_times = [float(rdis.get(x)) for x in out_names]
-##     def statdict(times):
-##         return dict(max=max(times),
-##                     min=min(times),
-##                     p90=abs(stats.lscoreatpercentile(times, 0.1)),
-##                     p99=abs(stats.lscoreatpercentile(times, 0.01)),
-##                     dev=stats.stdev(times))
-##     inbound = statdict(in_times)
-##     outbound = statdict(out_times)
-    
-
-    
-
-## >>> meanin = stats.mean(in_times)
-## indev = stats.stdev(in_times)
-## out90 = [float(x) for x in out_times], .1)
-## in99 = stats.lscoreatpercentile([float(x) for x in in_times], .01)
@@ -0,0 +1,344 @@
+"""
+Benchmarks for monkeytime itself: the per-request cost of the
+instrumentation, and log analysis throughput and peak memory over
+synthetic logs.
+
+    monkeytime-bench -n 500000 -o before.json
+    monkeytime-bench -n 500000 -o after.json -c before.json
+"""
+from datetime import datetime
+from datetime import timedelta
+from dateutil.parser import parse
+from functools import partial
+from monkeytime.analyze import PerfInfo
+from monkeytime.analyze import generate_perf_info
+from monkeytime.analyze import log_files
+from monkeytime.analyze import numpy
+from monkeytime.analyze import open_log
+from monkeytime.analyze import stats_to_csv
+from monkeytime.analyze import yield_stats
+from monkeytime.instr import BackgroundHandler
+from monkeytime.instr import LeanTraceProfile
+from monkeytime.instr import TraceProfile
+from monkeytime.instr import append_time_mw
+from monkeytime.instr import logging_timer_mw
+from path import path
+from webob import Request
+import json
+import logging
+import multiprocessing
+import optparse
+import os
+import platform
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+
+def synthetic_lines(howmany, uris=20, seed=0, start=datetime(2011, 5, 3)):
+    """
+    Generate perf.log style lines
+    """
+    rand = random.Random(seed)
+    uris = ["/svc%d/resource" %x for x in xrange(uris)]
+    when = start
+    for i in xrange(howmany):
+        when += timedelta(microseconds=rand.randint(0, 20000))
+        yield "%d %s [instr.inbound] :%06x:%06x %f %s %d\n" \
+              %(rand.randint(1000, 1010),
+                when.strftime("%Y-%m-%dT%H:%M:%S.%f"),
+                rand.getrandbits(24), rand.getrandbits(24),
+                rand.expovariate(20), rand.choice(uris),
+                rand.choice((200, 200, 200, 302, 404, 500)))
+
+
+def rate(func, items):
+    """
+    Items per second for calling func on each of items
+    """
+    start = time.time()
+    for item in items:
+        func(item)
+    return len(items) / (time.time() - start)
+
+
+def bench_parse(howmany=50000):
+    lines = list(synthetic_lines(howmany))
+    from_line = PerfInfo.from_line
+    return dict(dateutil=rate(lambda x: from_line(x, parse_ts=parse), lines),
+                fast=rate(from_line, lines))
+
+
+def per_call(func, howmany):
+    """
+    Microseconds per call of func
+    """
+    start = time.time()
+    for i in xrange(howmany):
+        func()
+    return (time.time() - start) / howmany * 1e6
+
+
+def bench_trace(howmany=100000, logname='monkeytime.bench'):
+    """
+    Per-trace overhead of entering and exiting each profile, with the
+    logger disabled (the common production case for DEBUG traces),
+    enabled with a handler writing to /dev/null, and with that handler
+    behind a BackgroundHandler
+    """
+    logger = logging.getLogger(logname)
+    logger.propagate = False
+    devnull = open(os.devnull, 'w')
+    handler = logging.StreamHandler(devnull)
+    handler.setFormatter(TraceProfile.default_formatter)
+    # the worker sleeps through the run, measuring only the enqueue
+    background = BackgroundHandler(handler, maxsize=howmany, batch=howmany + 1,
+                                   interval=3600)
+    logger.addHandler(handler)
+    parents = ('abc123', 'def456', '789abc')
+    msg = "%(parents)s:%(uid)s %(wall_time)f %(path)s %(status)s"
+    results = {}
+    for profile in TraceProfile, LeanTraceProfile:
+        def trace():
+            with profile(msg, logname=logname, parents=parents, path='/foo'):
+                pass
+        def timer():
+            with profile(uid=None, logname=None):
+                pass
+        name = profile.__name__
+        logger.setLevel(logging.INFO)
+        results[name + ' disabled'] = per_call(trace, howmany)
+        logger.setLevel(logging.DEBUG)
+        results[name + ' enabled'] = per_call(trace, howmany)
+        logger.removeHandler(handler)
+        logger.addHandler(background)
+        results[name + ' background'] = per_call(trace, howmany)
+        background.flush()
+        logger.removeHandler(background)
+        logger.addHandler(handler)
+        results[name + ' timer'] = per_call(timer, howmany)
+    background.close()
+    devnull.close()
+    return results
+
+
+def bare_app(environ, start_response):
+    body = "a line of text\n" * 20
+    start_response('200 OK', [('Content-Type', 'text/plain'),
+                              ('Content-Length', str(len(body)))])
+    return [body]
+
+
+def call_wsgi(app, environ):
+    def start_response(status, headers, exc_info=None):
+        pass
+    result = app(dict(environ), start_response)
+    for chunk in result:
+        pass
+    if hasattr(result, 'close'):
+        result.close()
+
+
+def bench_wsgi(howmany=20000, logname='monkeytime.bench.wsgi'):
+    """
+    Microseconds per request through a bare WSGI app and through each
+    middleware wrapping it, with traces written to /dev/null; the
+    'overhead' entries are the difference from the bare app
+    """
+    logger = logging.getLogger(logname)
+    logger.propagate = False
+    logger.setLevel(logging.DEBUG)
+    devnull = open(os.devnull, 'w')
+    handler = logging.StreamHandler(devnull)
+    handler.setFormatter(TraceProfile.default_formatter)
+    logger.addHandler(handler)
+    environ = Request.blank('/svc1/resource').environ
+    apps = dict(bare=bare_app,
+                logging_timer_mw=logging_timer_mw(bare_app, logname=logname),
+                lean_logging_timer_mw=logging_timer_mw(bare_app, logname=logname,
+                                                       profile=LeanTraceProfile),
+                append_time_mw=append_time_mw(bare_app))
+    results = {}
+    try:
+        for name, app in apps.iteritems():
+            results[name] = per_call(partial(call_wsgi, app, environ), howmany)
+    finally:
+        logger.removeHandler(handler)
+        devnull.close()
+    for name in apps:
+        if name != 'bare':
+            results[name + ' overhead'] = results[name] - results['bare']
+    return results
+
+
+def write_perf_logs(logdir, howmany, uris=20, files=1, seed=0):
+    """
+    Write `howmany` synthetic lines with `uris` distinct uris to
+    `logdir`, rotated over `files` files (perf.log.N oldest)
+    """
+    logdir = path(logdir)
+    lines = synthetic_lines(howmany, uris=uris, seed=seed)
+    per_file = howmany // files + 1
+    for num in reversed(xrange(files)):
+        name = num and "perf.log.%d" %num or "perf.log"
+        with open(logdir / name, 'w') as fh:
+            for i, line in zip(xrange(per_file), lines):
+                fh.write(line)
+    return logdir
+
+
+def count_perf_info(logdir, pattern="perf.log*"):
+    howmany = 0
+    for logfile in log_files(logdir, pattern):
+        for record in generate_perf_info(open_log(logfile)):
+            howmany += 1
+    return howmany
+
+
+def count_stats(logdir, pattern="perf.log*", vectorize=False, by=None, top=None):
+    return sum(1 for info in yield_stats(logdir, pattern, by=by, top=top, vectorize=vectorize))
+
+
+def write_csv(logdir, pattern="perf.log*"):
+    return stats_to_csv(logdir / "bench.csv", logdir, 60, pattern=pattern)
+
+
+def noop(*args):
+    pass
+
+
+def _measured(job):
+    func, args = job
+    sys.stdout = open(os.devnull, 'w')
+    start = time.time()
+    func(*args)
+    elapsed = time.time() - start
+    return elapsed, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def isolated(func, *args):
+    """
+    Run func(*args) in a fresh process; returns (seconds, peak rss in
+    kB). Forking carries over the parent's memory, see noop for the
+    baseline.
+    """
+    pool = multiprocessing.Pool(1)
+    try:
+        return pool.apply(_measured, ((func, args),))
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def bench_analysis(howmany=200000, uris=50, files=3, logdir=None):
+    """
+    Lines per second and peak memory for parsing, interval statistics
+    and csv output over synthetic logs (written to a temporary
+    directory unless `logdir` is given)
+    """
+    tmpdir = logdir is None and tempfile.mkdtemp(prefix='monkeytime-bench') or None
+    logdir = write_perf_logs(logdir or tmpdir, howmany, uris, files)
+    stages = [('baseline', noop, ()),
+              ('generate_perf_info', count_perf_info, (logdir,)),
+              ('yield_stats', count_stats, (logdir, "perf.log*", False)),
+              ('yield_stats by uri', count_stats, (logdir, "perf.log*", False, 'uri', 100)),
+              ('stats_to_csv', write_csv, (logdir,))]
+    if numpy is not None:
+        stages.insert(3, ('yield_stats numpy', count_stats, (logdir, "perf.log*", True)))
+    results = {}
+    try:
+        for name, func, args in stages:
+            elapsed, peak = isolated(func, *args)
+            results[name] = dict(seconds=elapsed, peak_rss_kb=peak,
+                                 lines_per_sec=func is not noop and howmany / elapsed or 0)
+    finally:
+        if tmpdir is not None:
+            shutil.rmtree(tmpdir)
+    return results
+
+
+def compare(old, new):
+    """
+    Print each figure of two result sets side by side
+    """
+    for section in sorted(new):
+        if section == 'meta' or section not in old:
+            continue
+        for name in sorted(new[section]):
+            before, after = old[section].get(name), new[section][name]
+            if isinstance(after, dict):
+                pairs = [("%s %s" %(name, key), (before or {}).get(key), value)
+                         for key, value in sorted(after.iteritems())]
+            else:
+                pairs = [(name, before, after)]
+            for label, before, after in pairs:
+                if not before:
+                    continue
+                print "%-10s %-36s %14.2f %14.2f %+7.1f%%" %(section, label, before, after,
+                                                              (after - before) / before * 100)
+
+
+def bench_parse_options(argv=None):
+    parser = optparse.OptionParser(usage="usage: %prog [options]")
+    parser.add_option('-n', '--lines', type="int", dest='lines', default=200000,
+                      help='Synthetic log lines to analyze')
+    parser.add_option('-u', '--uris', type="int", dest='uris', default=50,
+                      help='Distinct uris in the synthetic logs')
+    parser.add_option('-f', '--files', type="int", dest='files', default=3,
+                      help='Rotated files to spread the synthetic lines over')
+    parser.add_option('-r', '--requests', type="int", dest='requests', default=20000,
+                      help='Requests or traces per overhead measurement')
+    parser.add_option('-o', '--output', dest='output', default=None,
+                      help='Save the results as json')
+    parser.add_option('-c', '--compare', dest='compare', default=None,
+                      help='Compare with results saved earlier')
+    if argv is None:
+        argv = sys.argv
+    options, args = parser.parse_args(argv[1:])
+    return options
+
+
+def main(argv=None):
+    options = bench_parse_options(argv)
+    results = dict(meta=dict(python=platform.python_version(),
+                             platform=platform.platform(),
+                             numpy=numpy is not None and numpy.__version__ or None,
+                             when=datetime.now().isoformat(),
+                             lines=options.lines,
+                             uris=options.uris,
+                             files=options.files,
+                             requests=options.requests))
+
+    results['parse'] = bench_parse(options.lines)
+    for name in sorted(results['parse']):
+        print "parse_line %-10s %12.0f lines/sec" %(name, results['parse'][name])
+
+    results['trace'] = bench_trace(options.requests)
+    for name in sorted(results['trace']):
+        print "%-30s %8.2f usec/trace" %(name, results['trace'][name])
+
+    results['wsgi'] = bench_wsgi(options.requests)
+    for name in sorted(results['wsgi']):
+        print "%-30s %8.2f usec/request" %(name, results['wsgi'][name])
+
+    results['analysis'] = bench_analysis(options.lines, options.uris, options.files)
+    for name in sorted(results['analysis']):
+        stage = results['analysis'][name]
+        print "%-30s %12.0f lines/sec %10d kB peak" %(name, stage['lines_per_sec'],
+                                                        stage['peak_rss_kb'])
+
+    if options.output:
+        with open(options.output, 'w') as out:
+            json.dump(results, out, indent=2, sort_keys=True)
+        print "Results saved to %s" %options.output
+
+    if options.compare:
+        with open(options.compare) as fh:
+            compare(json.load(fh), results)
+
+
+if __name__ == '__main__':
+    main()
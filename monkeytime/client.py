@@ -0,0 +1,201 @@
+"""
+Traced HTTP client.
+
+Each request runs inside a child TraceProfile (of the current trace,
+see instr.trace_stack) whose header is sent downstream, over keep-alive
+connections from a pool. Time is split into phases -- connect, send,
+time to first byte, body read -- and kept per phase alongside the
+pool's hit and miss counts, to tell a slow downstream from connection
+churn.
+
+    client = TracedClient()
+    resp = client.request('GET', 'http://search.internal/q?term=monkey')
+    resp.status, resp.body, resp.timings
+"""
+from monkeytime.histogram import KeyedHistograms
+from monkeytime.instr import TraceProfile
+import httplib
+import socket
+import threading
+import time
+import urlparse
+
+
+class ConnectionPool(object):
+    """
+    Idle keep-alive httplib connections per (scheme, host, port), at
+    most `maxsize` of each kept
+    """
+
+    def __init__(self, maxsize=10, timeout=None):
+        self.maxsize = maxsize
+        self.timeout = timeout
+        self.idle = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.discarded = 0
+
+    def get(self, key):
+        """
+        (connection, reused) for `key`
+        """
+        with self.lock:
+            conns = self.idle.get(key)
+            if conns:
+                self.hits += 1
+                return conns.pop(), True
+            self.misses += 1
+        scheme, host, port = key
+        cls = scheme == 'https' and httplib.HTTPSConnection or httplib.HTTPConnection
+        return cls(host, port, timeout=self.timeout), False
+
+    def put(self, key, conn):
+        with self.lock:
+            conns = self.idle.setdefault(key, [])
+            if len(conns) < self.maxsize:
+                conns.append(conn)
+                return
+            self.discarded += 1
+        conn.close()
+
+    def close(self):
+        with self.lock:
+            idle, self.idle = self.idle, {}
+        for conns in idle.itervalues():
+            for conn in conns:
+                conn.close()
+
+    def stats(self):
+        with self.lock:
+            idle = sum(len(x) for x in self.idle.itervalues())
+        return dict(hits=self.hits, misses=self.misses, discarded=self.discarded, idle=idle)
+
+
+class TracedResponse(object):
+
+    def __init__(self, status, reason, headers, body, timings, reused):
+        self.status = status
+        self.reason = reason
+        self.headers = headers
+        self.body = body
+        self.timings = timings
+        self.reused = reused
+
+    def __repr__(self):
+        return "<%s %s %s>" % (self.__class__.__name__, self.status, self.reason)
+
+
+class TracedClient(object):
+    """
+    HTTP client over a ConnectionPool tracing each request
+
+    logname
+
+       logger for the outbound traces
+
+    profile
+
+       trace profile class, TraceProfile or LeanTraceProfile
+    """
+    phases = ('connect', 'send', 'ttfb', 'read')
+    # safe to send again after the server may have seen them
+    idempotent = frozenset(['GET', 'HEAD', 'OPTIONS', 'TRACE', 'PUT', 'DELETE'])
+    msg = "%(parents)s:%(uid)s %(wall_time)f %(path)s %(status)s"
+
+    def __init__(self, pool=None, logname='instr.outbound', profile=TraceProfile, top=100):
+        self.pool = pool or ConnectionPool()
+        self.logname = logname
+        self.profile = profile
+        # per phase timings, plus per host for the downstream's share;
+        # shared by every thread using the client
+        self.lock = threading.Lock()
+        self.timings = KeyedHistograms()
+        self.hosts = KeyedHistograms(top)
+
+    def request(self, method, url, body=None, headers=None):
+        parts = urlparse.urlsplit(url)
+        scheme = parts.scheme or 'http'
+        port = parts.port or (scheme == 'https' and 443 or 80)
+        key = scheme, parts.hostname, port
+        target = parts.path or '/'
+        if parts.query:
+            target += '?' + parts.query
+
+        with self.profile(self.msg, logname=self.logname, path=url, method=method) as prof:
+            headers = prof.prepare_outbound(headers or {})
+            conn, reused = self.pool.get(key)
+            try:
+                resp, timings = self.send(conn, method, target, body, headers)
+            except (socket.error, httplib.HTTPException), e:
+                conn.close()
+                if not reused or getattr(e, 'sent', False) and method not in self.idempotent:
+                    raise
+                # the server closed an idle keep-alive connection; retry once
+                conn, reused = self.pool.get(key)
+                try:
+                    resp, timings = self.send(conn, method, target, body, headers)
+                except Exception:
+                    conn.close()
+                    raise
+            except Exception:
+                conn.close()
+                raise
+            prof.extra['status'] = resp.status
+            prof.extra.update(timings)
+
+        if resp.will_close:
+            conn.close()
+        else:
+            self.pool.put(key, conn)
+
+        with self.lock:
+            for phase, elapsed in timings.iteritems():
+                self.timings.add(phase, elapsed)
+            self.hosts.add("%s:%s" %(parts.hostname, port), timings['ttfb'] + timings['read'])
+        return TracedResponse(resp.status, resp.reason, resp.getheaders(), resp.body,
+                              timings, reused)
+
+    def send(self, conn, method, target, body, headers):
+        start = time.time()
+        if conn.sock is None:
+            conn.connect()
+        connected = time.time()
+        conn.request(method, target, body, headers)
+        sent = time.time()
+        try:
+            resp = conn.getresponse()
+            first = time.time()
+            resp.body = resp.read()
+        except Exception, e:
+            # the server may have acted on the request
+            e.sent = True
+            raise
+        done = time.time()
+        return resp, dict(connect=connected - start,
+                          send=sent - connected,
+                          ttfb=first - sent,
+                          read=done - first)
+
+    def get(self, url, headers=None):
+        return self.request('GET', url, headers=headers)
+
+    def post(self, url, body, headers=None):
+        return self.request('POST', url, body, headers)
+
+    def stats(self):
+        """
+        Pool counters and mean/p99 milliseconds per phase and host
+        """
+        def summary(hists):
+            return dict((key, dict(count=hist.count,
+                                   mean=hist.mean * 1000,
+                                   p99th=hist.percentile(0.99) * 1000))
+                        for key, hist in hists.items() if hist.count)
+        with self.lock:
+            return dict(pool=self.pool.stats(),
+                        phases=summary(self.timings),
+                        hosts=summary(self.hosts))
+
+    def close(self):
+        self.pool.close()
@@ -0,0 +1,178 @@
+"""
+Live interval statistics from the active log.
+
+    monkeytime-analyze follow -i 60 logdir
+"""
+from collections import deque
+from monkeytime.analyze import PerfInfo
+from monkeytime.analyze import bucket_floor
+from monkeytime.analyze import epoch_timestamp
+from monkeytime.analyze import ext2int
+from monkeytime.analyze import group_key
+from monkeytime.analyze import interval_stats
+from monkeytime.histogram import KeyedHistograms
+from monkeytime.logreader import LogReader
+from path import path
+import os
+import time
+
+
+class LogFollower(object):
+    """
+    Iterate the lines appended to `logdir`/`name`, forever.
+
+    When the log is rotated (renamed to name.1, see ext2int) the rest of
+    the old file is read before moving on to the new one; a truncated
+    log is read again from the top. Yields None whenever a poll finds
+    nothing new, so consumers can act on idle time.
+    """
+
+    def __init__(self, logdir, name="perf.log", poll=1.0, from_start=False):
+        self.logdir = path(logdir)
+        self.name = name
+        self.poll = poll
+        self.current = self.logdir / name
+        self.ino = None
+        self.offset = 0
+        if not from_start and self.current.exists():
+            stat = os.stat(self.current)
+            self.ino, self.offset = stat.st_ino, stat.st_size
+
+    def __iter__(self):
+        while True:
+            idle = True
+            for line in self.poll_once():
+                idle = False
+                yield line
+            if idle:
+                yield None
+                time.sleep(self.poll)
+
+    def rotated(self):
+        """
+        The rotated file that used to be the active log, if any
+        """
+        candidates = sorted((ext2int(x.ext), x) for x in self.logdir.files(self.name + ".*")
+                            if x.ext[1:].isdigit())
+        for num, candidate in candidates:
+            if os.stat(candidate).st_ino == self.ino:
+                return candidate
+        return None
+
+    def drain(self, filename, whole_lines=True):
+        reader = LogReader(filename, start=self.offset, whole_lines=whole_lines)
+        for line in reader:
+            self.offset = reader.offset
+            yield line
+
+    def poll_once(self):
+        try:
+            stat = os.stat(self.current)
+        except OSError:
+            # mid-rotation
+            return
+
+        if self.ino is not None and stat.st_ino != self.ino:
+            rotated = self.rotated()
+            if rotated is not None:
+                for line in self.drain(rotated, whole_lines=False):
+                    yield line
+            self.offset = 0
+        elif stat.st_size < self.offset:
+            self.offset = 0
+        self.ino = stat.st_ino
+
+        for line in self.drain(self.current):
+            yield line
+
+
+class IntervalWindow(object):
+    """
+    Buckets parsed records into `interval` second KeyedHistograms and
+    hands back statdicts as buckets close.
+
+    A bucket closes once a record `lateness` seconds past its end turns
+    up; records for buckets already closed are dropped (and counted in
+    `late`). With `window` > 1 each row's figures cover the trailing
+    `window` intervals rather than just the one closing. Only the open
+    buckets and the trailing window are kept.
+    """
+
+    def __init__(self, interval=60, window=1, lateness=5, by=None, top=None):
+        self.interval = interval
+        self.window = window
+        self.lateness = lateness
+        self.by = by
+        self.top = top
+        self.keyfunc = group_key(by)
+        self.buckets = {}
+        self.recent = deque(maxlen=window)
+        self.closed = None
+        self.latest = None
+        self.late = 0
+
+    def add(self, info):
+        start = bucket_floor(info.dt, self.interval)
+        if self.closed is not None and start <= self.closed:
+            self.late += 1
+            return []
+        hists = self.buckets.get(start)
+        if hists is None:
+            hists = self.buckets[start] = KeyedHistograms(self.top)
+        hists.add(self.keyfunc and self.keyfunc(info), info.howlong)
+
+        now = bucket_floor(info.dt, 1)
+        if now <= self.latest:
+            return []
+        self.latest = now
+        return self.close(now - self.lateness)
+
+    def close(self, upto):
+        """
+        Close every bucket ending by epoch `upto`
+        """
+        rows = []
+        interval = self.interval
+        for start in sorted(x for x in self.buckets if x + interval <= upto):
+            self.recent.append((start, self.buckets.pop(start)))
+            self.closed = start
+            merged = KeyedHistograms(self.top)
+            for then, hists in self.recent:
+                if then > start - self.window * interval:
+                    merged.merge(hists)
+            rows.extend(interval_stats(merged, epoch_timestamp(start), interval, self.by))
+        return rows
+
+    def flush(self):
+        if not self.buckets:
+            return []
+        return self.close(max(self.buckets) + self.interval)
+
+
+def follow_stats(lines, interval=60, window=1, lateness=5, by=None, top=None, **filters):
+    """
+    Yield statdicts from an endless iterable of lines (a LogFollower)
+    as each interval closes (see IntervalWindow). Everything open is
+    closed when no lines have arrived for a whole interval.
+    """
+    buckets = IntervalWindow(interval, window, lateness, by, top)
+    heard = time.time()
+    for line in lines:
+        if line is None:
+            if time.time() - heard > interval:
+                for statinfo in buckets.flush():
+                    yield statinfo
+            continue
+
+        heard = time.time()
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            info = PerfInfo.from_line(line)
+        except ValueError:
+            continue
+        if info.old or any(test(info.get(key)) for key, test in filters.iteritems()):
+            continue
+        for statinfo in buckets.add(info):
+            yield statinfo
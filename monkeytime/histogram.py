@@ -0,0 +1,239 @@
+"""
+Bounded memory latency histograms.
+
+Values are counted into logarithmic buckets (each bucket covers a
+fixed relative width), so memory depends on the dynamic range of the
+data rather than on how many values were seen. Mean and variance are
+kept exactly with Welford's running update.
+"""
+import math
+
+
+class LatencyHistogram(object):
+    """
+    Streaming, mergeable histogram of durations (in seconds)
+
+    accuracy
+
+       relative error bound on percentile estimates (0.01 == 1%)
+    """
+
+    def __init__(self, accuracy=0.01):
+        self.accuracy = accuracy
+        self.gamma = (1 + accuracy) / (1 - accuracy)
+        self.lngamma = math.log(self.gamma)
+        self.bins = {}
+        self.zeros = 0
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.min = None
+        self.max = None
+
+    @classmethod
+    def from_values(cls, values, **kw):
+        hist = cls(**kw)
+        add = hist.add
+        for value in values:
+            add(value)
+        return hist
+
+    def __len__(self):
+        return self.count
+
+    def __nonzero__(self):
+        return self.count > 0
+
+    def bucket(self, value):
+        return int(math.ceil(math.log(value) / self.lngamma))
+
+    def bucket_value(self, idx):
+        return 2 * self.gamma ** idx / (self.gamma + 1)
+
+    def add(self, value, count=1):
+        if value > 0:
+            idx = int(math.ceil(math.log(value) / self.lngamma))
+            self.bins[idx] = self.bins.get(idx, 0) + count
+        else:
+            self.zeros += count
+
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+        total = self.count + count
+        delta = value - self.mean
+        self.mean += delta * count / total
+        self.m2 += delta * (value - self.mean) * count
+        self.count = total
+
+    def merge(self, other):
+        """
+        Fold another histogram (of the same accuracy) into this one
+        """
+        if not other.count:
+            return self
+        if other.accuracy != self.accuracy:
+            raise ValueError("Cannot merge histograms of differing accuracy")
+
+        bins = self.bins
+        for idx, num in other.bins.iteritems():
+            bins[idx] = bins.get(idx, 0) + num
+        self.zeros += other.zeros
+
+        total = self.count + other.count
+        delta = other.mean - self.mean
+        self.m2 += other.m2 + delta * delta * self.count * other.count / total
+        self.mean += delta * other.count / total
+        self.count = total
+
+        if self.min is None or other.min < self.min:
+            self.min = other.min
+        if self.max is None or other.max > self.max:
+            self.max = other.max
+        return self
+
+    def copy(self):
+        new = self.__class__(accuracy=self.accuracy)
+        return new.merge(self)
+
+    def percentile(self, fraction):
+        """
+        Estimated value at `fraction` (0.0 - 1.0) of the distribution
+        """
+        if not self.count:
+            raise ValueError("percentile of empty histogram")
+        rank = fraction * (self.count - 1)
+        seen = self.zeros
+        if rank < seen:
+            return self.min
+        value = self.max
+        for idx in sorted(self.bins):
+            seen += self.bins[idx]
+            if rank < seen:
+                value = self.bucket_value(idx)
+                break
+        return min(max(value, self.min), self.max)
+
+    @property
+    def median(self):
+        return self.percentile(0.5)
+
+    @property
+    def variance(self):
+        if self.count < 2:
+            return 0.0
+        return self.m2 / (self.count - 1)
+
+    @property
+    def stdev(self):
+        return math.sqrt(self.variance)
+
+    def to_state(self):
+        """
+        Plain (json-able) representation for persistence
+        """
+        return dict(accuracy=self.accuracy,
+                    bins=sorted(self.bins.items()),
+                    zeros=self.zeros,
+                    count=self.count,
+                    mean=self.mean,
+                    m2=self.m2,
+                    min=self.min,
+                    max=self.max)
+
+    @classmethod
+    def from_state(cls, state):
+        hist = cls(accuracy=state['accuracy'])
+        hist.bins = dict((int(idx), num) for idx, num in state['bins'])
+        for attr in ('zeros', 'count', 'mean', 'm2', 'min', 'max'):
+            setattr(hist, attr, state[attr])
+        return hist
+
+    def __getstate__(self):
+        return self.to_state()
+
+    def __setstate__(self, state):
+        self.__dict__.update(self.from_state(state).__dict__)
+
+    def __repr__(self):
+        return "<%s count=%d>" % (self.__class__.__name__, self.count)
+
+
+class KeyedHistograms(object):
+    """
+    A LatencyHistogram per key (uri, status class...), capped at `top`
+    keys. Membership follows Space-Saving: once full, the key with the
+    lowest estimated count is folded into the OTHER histogram to make
+    room, and the newcomer inherits that count (kept in `errors`), so
+    heavy keys that show up late still displace the light ones and
+    high cardinality keys cannot grow memory without bound.
+
+    factory
+
+       class of the per key values, LatencyHistogram or anything with
+       its add, merge and count (vectorized.Samples)
+    """
+    OTHER = '<other>'
+
+    def __init__(self, top=None, accuracy=0.01, factory=LatencyHistogram):
+        self.top = top
+        self.accuracy = accuracy
+        self.factory = factory
+        self.hists = {}
+        self.errors = {}
+
+    def __len__(self):
+        return len(self.hists)
+
+    @property
+    def count(self):
+        return sum(hist.count for hist in self.hists.itervalues())
+
+    def weight(self, key):
+        """
+        Estimated count of `key`: its own values plus the count it
+        inherited on admission
+        """
+        return self.hists[key].count + self.errors.get(key, 0)
+
+    def histogram(self, key):
+        hist = self.hists.get(key)
+        if hist is None:
+            if self.top and key != self.OTHER:
+                nkeys = len(self.hists) - (self.OTHER in self.hists)
+                if nkeys >= self.top:
+                    self.errors[key] = self.evict()
+            hist = self.hists[key] = self.factory(accuracy=self.accuracy)
+        return hist
+
+    def add(self, key, value):
+        self.histogram(key).add(value)
+
+    def evict(self):
+        """
+        Fold the lightest key into OTHER; returns its estimated count
+        """
+        num, victim = min((self.weight(key), key) for key in self.hists
+                          if key != self.OTHER)
+        self.errors.pop(victim, None)
+        self.histogram(self.OTHER).merge(self.hists.pop(victim))
+        return num
+
+    def merge(self, other):
+        for key, hist in other.hists.iteritems():
+            self.histogram(key).merge(hist)
+            if key in other.errors:
+                self.errors[key] = self.errors.get(key, 0) + other.errors[key]
+        return self
+
+    def items(self):
+        """
+        (key, histogram) pairs, busiest first
+        """
+        return sorted(self.hists.iteritems(), key=lambda item: item[1].count,
+                      reverse=True)
+
+    def __repr__(self):
+        return "<%s keys=%d>" % (self.__class__.__name__, len(self.hists))
@@ -0,0 +1,269 @@
+"""
+Per-request index of parsed logs.
+
+Answers questions about individual requests -- the slowest calls to a
+uri in a time range, every request made on behalf of an origin --
+with index lookups instead of log scans. Records are written in
+batches. The default backend is an sqlite file; a redis backend is
+available where the redis client is installed.
+
+    monkeytime-analyze index --index perf.index --slowest /foo logdir
+    monkeytime-analyze index --index redis://localhost:6379/0 --origin 3fa2c1 logdir
+"""
+from monkeytime.analyze import generate_perf_info
+from monkeytime.analyze import log_files
+from monkeytime.analyze import open_log
+from monkeytime.logreader import first_line
+from monkeytime.traces import epoch
+import json
+import os
+import sqlite3
+
+fields = ('uid', 'origin', 'parent', 'ts', 'howlong', 'uri', 'status', 'inout', 'pid')
+
+
+def record(info):
+    """
+    Index row for a PerfInfo; a root request is its own origin
+    """
+    return (info.uid, info.origin or info.uid, info.parent, epoch(info.dt),
+            info.howlong, info.uri, info.status, info.inout, info.pid)
+
+
+class BaseIndex(object):
+    """
+    Common loading for the index backends, which provide
+
+    add_many(rows)
+
+       store rows (see record), returning how many were new; a row
+       already stored (same uid, pid and ts) is skipped, uids alone
+       are too short to tell requests apart
+
+    slowest(uri, start=None, end=None, limit=10)
+
+       the `limit` slowest requests for `uri` between epochs `start`
+       and `end`, slowest first
+
+    children(origin)
+
+       every request made on behalf of `origin` (itself included),
+       oldest first
+
+    resume(dev, ino, head) and remember(dev, ino, head, name, offset)
+
+       how far into a log file (by inode, and first line in case it
+       was replaced) earlier loads got
+
+    Rows come back as dicts of `fields`, with ts in epoch seconds.
+    """
+    batch = 10000
+
+    def close(self):
+        pass
+
+    def load(self, lines, **filters):
+        """
+        Index parsed lines in batches; returns (read, new)
+        """
+        marker = object()
+        read = new = 0
+        rows = []
+        for uid, info, blob in generate_perf_info(lines, marker=marker, **filters):
+            if uid is marker:
+                break
+            rows.append(record(info))
+            if len(rows) >= self.batch:
+                read += len(rows)
+                new += self.add_many(rows)
+                rows = []
+        if rows:
+            read += len(rows)
+            new += self.add_many(rows)
+        return read, new
+
+    def update_file(self, logfile, **filters):
+        """
+        Index the lines appended to `logfile` since it was last loaded
+        """
+        stat = os.stat(logfile)
+        head = first_line(logfile)
+        offset = self.resume(stat.st_dev, stat.st_ino, head)
+        if offset > stat.st_size:
+            offset = 0
+        if offset == stat.st_size:
+            return 0, 0
+        reader = open_log(logfile, start=offset, whole_lines=True)
+        read, new = self.load(reader, **filters)
+        self.remember(stat.st_dev, stat.st_ino, head, str(logfile), reader.offset)
+        return read, new
+
+    def update(self, logdir, pattern="perf.log*", **filters):
+        read = new = 0
+        for logfile in log_files(logdir, pattern):
+            print "File: %s" %logfile
+            fread, fnew = self.update_file(logfile, **filters)
+            read += fread
+            new += fnew
+        return read, new
+
+
+class SqliteIndex(BaseIndex):
+    """
+    Index in an sqlite file. Reloading a log only reads what was
+    appended since, and rows already stored are skipped.
+    """
+    schema = """
+    create table if not exists requests (
+        id integer primary key,
+        uid text,
+        origin text,
+        parent text,
+        ts real,
+        howlong real,
+        uri text,
+        status integer,
+        inout text,
+        pid text,
+        unique (uid, pid, ts));
+    create index if not exists requests_uri_ts on requests (uri, ts);
+    create index if not exists requests_uri_howlong on requests (uri, howlong);
+    create index if not exists requests_origin on requests (origin, ts);
+    create index if not exists requests_parent on requests (parent);
+    create table if not exists files (
+        dev integer,
+        ino integer,
+        head text,
+        name text,
+        offset integer,
+        primary key (dev, ino));
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.db = sqlite3.connect(filename)
+        # uris and file heads are log bytes, not necessarily ascii
+        self.db.text_factory = str
+        self.db.executescript(self.schema)
+
+    def add_many(self, rows):
+        before = self.db.total_changes
+        self.db.executemany("insert or ignore into requests (%s) values (?, ?, ?, ?, ?, ?, ?, ?, ?)"
+                            %", ".join(fields), rows)
+        self.db.commit()
+        return self.db.total_changes - before
+
+    def resume(self, dev, ino, head):
+        row = self.db.execute("select head, offset from files where dev = ? and ino = ?",
+                              (dev, ino)).fetchone()
+        if row is None or row[0] and row[0] != head:
+            return 0
+        return row[1]
+
+    def remember(self, dev, ino, head, name, offset):
+        self.db.execute("insert or replace into files values (?, ?, ?, ?, ?)",
+                        (dev, ino, head, name, offset))
+        self.db.commit()
+
+    def select(self, where, args, order):
+        sql = "select %s from requests where %s order by %s" %(", ".join(fields), where, order)
+        return [dict(zip(fields, row)) for row in self.db.execute(sql, args)]
+
+    def slowest(self, uri, start=None, end=None, limit=10):
+        if start is None and end is None:
+            # walk the (uri, howlong) index backwards
+            return self.select("uri = ?", (uri,), "howlong desc limit %d" %limit)
+        return self.select("uri = ? and ts >= ? and ts < ?",
+                           (uri, start or 0, end or 2 ** 62),
+                           "howlong desc limit %d" %limit)
+
+    def children(self, origin):
+        return self.select("origin = ?", (origin,), "ts")
+
+    def close(self):
+        self.db.close()
+
+
+class RedisIndex(BaseIndex):
+    """
+    Index in redis: a hash per request, named by uid, pid and ts, plus
+    sorted sets of those names by time for each uri and origin, written
+    through a pipeline per batch. File offsets are kept in the
+    request:files hash.
+    """
+    batch = 1000
+
+    def __init__(self, host="localhost", port=6379, db=0):
+        import redis
+        self.redis = redis.Redis(host, port, db)
+
+    @staticmethod
+    def name(row):
+        uid, ts, pid = row[0], row[3], row[8]
+        return "%s:%s:%r" %(uid, pid, ts)
+
+    def add_many(self, rows):
+        pipe = self.redis.pipeline()
+        for row in rows:
+            pipe.hsetnx("request:%s" %self.name(row), 'uid', row[0])
+        fresh = [row for row, new in zip(rows, pipe.execute()) if new]
+        for row in fresh:
+            uid, origin, parent, ts, howlong, uri = row[:6]
+            name = self.name(row)
+            pipe.hmset("request:%s" %name, dict(zip(fields, row)))
+            pipe.zadd("request:when:uri:%s" %uri, **{name: ts})
+            pipe.zadd("request:howlong:uri:%s" %uri, **{name: howlong})
+            pipe.zadd("request:when:origin:%s" %origin, **{name: ts})
+        pipe.execute()
+        return len(fresh)
+
+    def resume(self, dev, ino, head):
+        known = self.redis.hget("request:files", "%s:%s" %(dev, ino))
+        if known is None:
+            return 0
+        known = json.loads(known)
+        if known['head'] and known['head'] != head:
+            return 0
+        return known['offset']
+
+    def remember(self, dev, ino, head, name, offset):
+        self.redis.hset("request:files", "%s:%s" %(dev, ino),
+                        json.dumps(dict(head=head, name=name, offset=offset)))
+
+    def fetch(self, names):
+        pipe = self.redis.pipeline()
+        for name in names:
+            pipe.hgetall("request:%s" %name)
+        rows = []
+        for row in pipe.execute():
+            if not row:
+                continue
+            for name in 'ts', 'howlong':
+                row[name] = float(row[name])
+            row['status'] = row['status'] != 'None' and int(row['status']) or None
+            rows.append(row)
+        return rows
+
+    def slowest(self, uri, start=None, end=None, limit=10):
+        if start is None and end is None:
+            names = self.redis.zrevrange("request:howlong:uri:%s" %uri, 0, limit - 1)
+            return self.fetch(names)
+        names = self.redis.zrangebyscore("request:when:uri:%s" %uri,
+                                         start or 0, "(%s" %(end or 2 ** 62))
+        rows = self.fetch(names)
+        rows.sort(key=lambda row: row['howlong'], reverse=True)
+        return rows[:limit]
+
+    def children(self, origin):
+        return self.fetch(self.redis.zrange("request:when:origin:%s" %origin, 0, -1))
+
+
+def open_index(spec):
+    """
+    An index for `spec`: redis://host[:port][/db], or an sqlite filename
+    """
+    if spec.startswith("redis://"):
+        location, slash, db = spec[len("redis://"):].partition("/")
+        host, colon, port = location.partition(":")
+        return RedisIndex(host or "localhost", int(port or 6379), int(db or 0))
+    return SqliteIndex(spec)
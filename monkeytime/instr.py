@@ -1,17 +1,130 @@
+from collections import deque
 from contextlib import contextmanager
 from datetime import datetime
 from functools import wraps, partial
+from itertools import count
 from memojito import mproperty
+from monkeytime.histogram import KeyedHistograms
 #from monkeylib.exc import HTTPException, HTTPNotFound
 from webob.exc import HTTPError, HTTPNotFound
+from webob import Response
 from webob.dec import wsgify
+import atexit
 import hashlib
+import json
 import logging
 import os
+import random
 import sys
+import threading
 import time
 
 
+class BackgroundHandler(logging.Handler):
+    """
+    Queue log records for a worker thread that hands them to `target`
+    in batches, flushing it once per batch.
+
+    The request thread only appends to a bounded deque (no handler
+    lock); records arriving while `maxsize` are already waiting are
+    dropped and counted in `dropped`. The worker wakes every `interval`
+    seconds, or sooner once `batch` records are waiting. Whatever is
+    left is written at close, which is registered with atexit.
+    """
+
+    def __init__(self, target, maxsize=10000, batch=500, interval=0.5):
+        logging.Handler.__init__(self)
+        self.target = target
+        self.maxsize = maxsize
+        self.batch = batch
+        self.interval = interval
+        self.queue = deque()
+        self.wake = threading.Event()
+        self.dropped = 0
+        self.emitted = 0
+        self.stopping = False
+        self.thread = None
+        self.pid = None
+        atexit.register(self.close)
+
+    def put(self, item):
+        """
+        Queue a LogRecord, or a (logger, level, msg, args, created)
+        tuple to be made into one by the worker
+        """
+        queue = self.queue
+        if len(queue) >= self.maxsize:
+            self.dropped += 1
+            return
+        queue.append(item)
+        if self.pid != os.getpid():
+            self.start()
+        if len(queue) == self.batch:
+            self.wake.set()
+
+    def handle(self, record):
+        if not self.filter(record):
+            return False
+        self.put(record)
+        return True
+
+    emit = handle
+
+    @staticmethod
+    def make_record(logger, level, msg, args, created):
+        record = logger.makeRecord(logger.name, level, __file__, 0, msg, (args,),
+                                   None, None, args)
+        record.created = created
+        record.msecs = (created - long(created)) * 1000
+        record.relativeCreated = (created - logging._startTime) * 1000
+        return record
+
+    def start(self):
+        """
+        Start the worker (again, after a fork)
+        """
+        self.pid = os.getpid()
+        self.stopping = False
+        self.thread = threading.Thread(target=self.run, name="monkeytime-log-writer")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+        while not self.stopping:
+            self.wake.wait(self.interval)
+            self.wake.clear()
+            self.drain()
+
+    def drain(self):
+        popleft = self.queue.popleft
+        handle = self.target.handle
+        written = 0
+        while True:
+            try:
+                record = popleft()
+            except IndexError:
+                break
+            if type(record) is tuple:
+                record = self.make_record(*record)
+            handle(record)
+            written += 1
+        if written:
+            self.target.flush()
+            self.emitted += written
+        return written
+
+    def flush(self):
+        self.drain()
+
+    def close(self):
+        self.stopping = True
+        self.wake.set()
+        if self.thread is not None and self.pid == os.getpid():
+            self.thread.join(self.interval * 4)
+        self.drain()
+        logging.Handler.close(self)
+
+
 def nuuid(*args):
     uobj = hashlib.md5()
     [uobj.update(str(x)) for x in args]
@@ -19,8 +132,306 @@ def nuuid(*args):
 
 _marker = object()
 
-        
-class TraceProfile(object):
+# distinguishes traces sharing a lineage, second and pid
+_sequence = count()
+
+
+class TraceSampler(object):
+    """
+    Decides which traces get logged.
+
+    rate
+
+       fraction of traces logged, decided once at the origin (the
+       request that arrives without an X-Request-Trace header) and
+       honored downstream via X-Request-Trace-Sampled, a header of its
+       own so that services predating sampling ignore it
+
+    slow
+
+       traces slower than this many seconds are logged regardless
+
+    errors
+
+       log traces ending in a server error (status >= 500) regardless
+
+    Counts of traces logged because they were sampled, slow or errors,
+    and of traces dropped, are kept as attributes.
+    """
+
+    def __init__(self, rate=1.0, slow=None, errors=True):
+        self.rate = rate
+        self.slow = slow
+        self.errors = errors
+        self.sampled = self.kept_slow = self.kept_errors = self.dropped = 0
+
+    def decide(self, header=None, flag=None):
+        """
+        Head decision for a trace arriving with trace `header` and
+        sampling `flag` headers
+        """
+        if header is not None:
+            if flag is None:
+                # upstream predates sampling
+                return True
+            return flag != '0'
+        return self.rate >= 1 or random.random() < self.rate
+
+    def keep(self, profile):
+        """
+        Tail decision for a finished trace
+        """
+        if profile.sampled:
+            self.sampled += 1
+            return True
+        if self.errors and profile.extra.get('status', 0) >= 500:
+            self.kept_errors += 1
+            return True
+        if self.slow is not None and profile.wall_elapsed > self.slow:
+            self.kept_slow += 1
+            return True
+        self.dropped += 1
+        return False
+
+    def stats(self):
+        return dict(sampled=self.sampled, kept_slow=self.kept_slow,
+                    kept_errors=self.kept_errors, dropped=self.dropped)
+
+default_sampler = TraceSampler()
+
+
+def make_local():
+    """
+    A greenlet local if gevent has patched threading, else a thread
+    local
+    """
+    try:
+        from gevent import monkey
+        if monkey.is_module_patched('threading'):
+            from gevent.local import local
+            return local()
+    except ImportError:
+        pass
+    return threading.local()
+
+_context = None
+
+
+def trace_stack():
+    """
+    The trace profiles entered, and not yet exited, in the current
+    thread or greenlet; innermost last
+    """
+    global _context
+    try:
+        return _context.stack
+    except AttributeError:
+        if _context is None:
+            # made on first use, so gevent may patch after import
+            _context = make_local()
+        stack = _context.stack = []
+        return stack
+
+
+def current_trace():
+    """
+    The innermost active trace profile, or None
+    """
+    stack = trace_stack()
+    return stack and stack[-1] or None
+
+
+def bind_trace(func, profile=None):
+    """
+    Wrap `func` to run with `profile` (by default the current trace)
+    active, for handing work to another thread or greenlet
+    """
+    profile = profile or current_trace()
+    @wraps(func)
+    def bound(*args, **kw):
+        if profile is None:
+            return func(*args, **kw)
+        stack = trace_stack()
+        stack.append(profile)
+        try:
+            return func(*args, **kw)
+        finally:
+            stack.remove(profile)
+    return bound
+
+
+def outbound_headers(headers, **kw):
+    """
+    `headers` stamped with the current trace (see prepare_outbound), or
+    unchanged when there isn't one
+    """
+    profile = current_trace()
+    if profile is None:
+        return headers
+    return profile.prepare_outbound(headers, **kw)
+
+
+class BaseTraceProfile(object):
+    """
+    Header propagation and construction shared by the trace profiles.
+
+    Entered profiles with a uid are kept on the trace_stack: one
+    without a lineage of its own (not built from headers or given
+    parents) becomes a child of the trace active when it is entered.
+    Set `implicit` False to opt out.
+    """
+    __slots__ = ()
+
+    HEADER = 'X-Request-Trace'
+    SAMPLED_HEADER = 'X-Request-Trace-Sampled'
+    IGNORE_HEADER = 'X-Ignore-Request-Trace'
+    httperror, httpnotfound = HTTPError, HTTPNotFound
+
+    def status_for(self, exc_type):
+        """
+        Status to record for a block exiting with `exc_type`
+        """
+        if exc_type is self.httpnotfound:
+            return 404
+        elif exc_type and issubclass(exc_type, self.httperror):
+            return 500
+        elif exc_type and issubclass(exc_type, Exception):
+            return 600
+        return None
+
+    def make_header(self, parent_headers=None, base_trace = "::"):
+        trace = base_trace
+        if parent_headers is not None:
+            trace = parent_headers.get(self.HEADER)
+            if trace is None:
+                raise ValueError("No %s header found" %self.HEADER)
+            origin, parent = self.parse_header(trace, parent_only=True)
+        else:
+            origin, parent = self.origin and self.origin or '',\
+                             self.parent and self.parent or '',
+        return ":".join((origin, parent, self.uid))
+
+    @classmethod
+    def parents(cls, headers):
+        header = headers.get(cls.HEADER)
+        if header is not None:
+            return cls.parse_header(header)
+        return '','',''
+
+    @staticmethod
+    def parse_header(header, parent_only=False):
+        origin, grandparent, parent = header.split(":", 3)[:3]
+        if not parent_only:
+            return origin, grandparent, parent
+        return origin, parent
+
+    def keep(self):
+        """
+        Whether this finished trace should be logged
+        """
+        return self.sampler.keep(self)
+
+    implicit = True
+
+    def adopt(self, parent):
+        """
+        Take `parent` as the upstream trace, as if its outbound headers
+        had been received: lineage, sampling and, for a parent that
+        isn't logged (an excluded or ignored request), not being
+        logged either, which prepare_outbound passes on downstream
+        """
+        origin = parent.origin or parent.uid
+        self.origin, self.grandpa, self.parent = origin, parent.parent or origin, parent.uid
+        self.lineage = self.origin, self.grandpa, self.parent
+        self.sampled = parent.sampled
+        if parent.logname is None:
+            self.logname = self.logger = None
+
+    def enter_context(self):
+        stack = trace_stack()
+        if stack and not self.parent:
+            self.adopt(stack[-1])
+        stack.append(self)
+
+    def exit_context(self):
+        stack = trace_stack()
+        if stack and stack[-1] is self:
+            stack.pop()
+        elif self in stack:
+            stack.remove(self)
+
+    @classmethod
+    def decorate(cls, prof):
+        def wrap_func(func):
+            @wraps(func)
+            def wrapper(*args, **kw):
+                with prof:
+                    return func(*args, **kw)
+            return wrapper
+        return wrap_func
+
+    @classmethod
+    def from_headers(cls, headers, msg="%(parents)s:%(uid)s %(trace_time)s",
+                     logname='instr.request', uid=_marker, sampler=None, **kwargs):
+        parents = cls.parents(headers)
+        sampler = sampler or default_sampler
+        sampled = sampler.decide(headers.get(cls.HEADER), headers.get(cls.SAMPLED_HEADER))
+        return cls(msg, logname, uid, parents, sampled=sampled, sampler=sampler, **kwargs)
+
+    lognames = 'instr', 'instr.inbound', 'instr.inbound',
+
+    recorders = ()
+
+    @classmethod
+    def add_recorder(cls, recorder):
+        """
+        Call `recorder` with every finished, logged trace (profiles
+        without a logname, like Timer, are not recorded)
+        """
+        BaseTraceProfile.recorders += (recorder,)
+
+    @classmethod
+    def remove_recorder(cls, recorder):
+        BaseTraceProfile.recorders = tuple(x for x in BaseTraceProfile.recorders
+                                           if x is not recorder)
+
+    default_formatter = logging.Formatter("%(levelname)-10s %(asctime)s %(message)s")
+    default_handler = logging.StreamHandler(sys.stderr)
+
+    def prepare_outbound(self, headers, **kw):
+        self.extra.update(kw)
+        headers = headers.copy()
+        headers[self.HEADER] = self.make_header()
+        headers[self.SAMPLED_HEADER] = self.sampled and '1' or '0'
+        if self.logname is None:
+            headers[self.IGNORE_HEADER] = 'true'
+        return headers
+
+    @classmethod
+    def configure_logs(cls, handler=default_handler, formatter=default_formatter,
+                       background=False, **kw):
+        """
+        background
+
+           write records from a worker thread (a BackgroundHandler
+           wrapping `handler`, configured by any other keywords) so
+           that emitting a trace is only an enqueue for the caller
+        """
+        handler.setFormatter(formatter)
+        if background:
+            # lets LeanTraceProfile skip building LogRecords inline
+            # (see queue_handler)
+            handler = BackgroundHandler(handler, **kw)
+        for name in cls.lognames:
+            if any(name.startswith(other + '.') for other in cls.lognames):
+                # records propagate up to the parent's handler already
+                continue
+            logger = logging.getLogger(name)
+            logger.addHandler(handler)
+        return handler
+
+
+class TraceProfile(BaseTraceProfile):
     """
     Context manager and decorator for identifying, timing and logging
     times for a block of code.
@@ -28,14 +439,10 @@ class TraceProfile(object):
     Meant for timing network interactions.
     """ 
 
-    HEADER = 'X-Request-Trace'
-    IGNORE_HEADER = 'X-Ignore-Request-Trace'
-    httperror, httpnotfound = HTTPError, HTTPNotFound
-    
-    
     def __init__(self, msg="%(uid)s %(trace_time)s %(parents)s",
                  logname='monkeylib.instr', uid=_marker, parents=None,
-                 quiet=False, level=logging.DEBUG, **kwargs):
+                 quiet=False, level=logging.DEBUG, sampled=True, sampler=None,
+                 **kwargs):
         """
         msg
 
@@ -54,6 +461,11 @@ class TraceProfile(object):
 
            : delimited string of identifiers for upstream events
 
+        sampled, sampler
+
+           head sampling decision for this trace, and the TraceSampler
+           that has the final say on unsampled ones
+
         kwargs
 
            anything else required by the 'msg' format string
@@ -68,6 +480,8 @@ class TraceProfile(object):
         self.origin, self.grandpa, self.parent = ('', '', '')
         self.lineage = self.unpack_lineage(parents)
         self.elapsed = None
+        self.sampled = sampled
+        self.sampler = sampler or default_sampler
 
     def unpack_lineage(self, parents):
         """
@@ -107,131 +521,499 @@ class TraceProfile(object):
         return None
 
     def __enter__(self):
-        if self.uid is not None and self.uid is _marker:
-            self.uid = self.uuid_gen(":".join(self.lineage), self.created, str(self.pid))
+        if self.uid is not None:
+            if self.implicit:
+                self.enter_context()
+            if self.uid is _marker:
+                self.uid = self.uuid_gen(":".join(self.lineage), self.created, str(self.pid),
+                                         next(_sequence))
         self.clock_start_time = time.clock()
         self.wall_start_time = time.time()
         return self
 
     def __exit__(self, exc_type, exc_value, exc_tb):
-        self.extra['status'] = self.extra.get('status', 0)
-        if exc_type is self.httpnotfound:
-            self.extra['status'] = 404
-        elif exc_type and issubclass(exc_type, self.httperror):
-            self.extra['status'] = 500
-        elif exc_type and issubclass(exc_type, Exception):
-            self.extra['status'] = 600            
+        self.extra['status'] = self.status_for(exc_type) or self.extra.get('status', 0)
 
         clock_end = time.clock()
         wall_end = time.time()
+        if self.uid is not None and self.implicit:
+            self.exit_context()
         
         self.extra['uid'] = self.uid
         self.extra['parents'] = "%s:%s" %(self.origin, self.parent)
         self.extra['clock_time'] = self.clock_elapsed = clock_end - self.clock_start_time
         self.extra['wall_time'] = self.wall_elapsed = wall_end - self.wall_start_time
-        if self.log is not None:
+        if self.log is not None and self.keep():
             self.log(self.msg, self.extra)
+            for recorder in self.recorders:
+                recorder(self)
         return False
 
-    def make_header(self, parent_headers=None, base_trace = "::"):
-        trace = base_trace
-        if parent_headers is not None:
-            trace = parent_headers.get(self.HEADER)
-            if trace is None:
-                raise ValueError("No %s header found" %self.HEADER)
-            origin, parent = self.parse_header(trace, parent_only=True)
-        else:
-            origin, parent = self.origin and self.origin or '',\
-                             self.parent and self.parent or '',
-        return ":".join((origin, parent, self.uid))
 
-    @classmethod
-    def parents(cls, headers):
-        header = headers.get(cls.HEADER)
-        if header is not None:
-            return cls.parse_header(header)
-        return '','',''
+class UidSource(object):
+    """
+    Cheap random 6 hex digit uids. The generator is reseeded from
+    os.urandom whenever the pid changes, so forked workers never share
+    a sequence.
+    """
 
-    @staticmethod
-    def parse_header(header, parent_only=False):
-        origin, grandparent, parent = header.split(":")
-        if not parent_only:
-            return origin, grandparent, parent
-        return origin, parent
+    def __init__(self):
+        self.pid = None
+        self.rand = None
 
-    @classmethod
-    def decorate(cls, prof):
-        def wrap_func(func):
-            @wraps(func)
-            def wrapper(*args, **kw):
-                with prof:
-                    return func(*args, **kw)
-            return wrapper
-        return wrap_func
+    def __call__(self):
+        pid = os.getpid()
+        if pid != self.pid:
+            self.pid = pid
+            self.rand = random.Random(long(os.urandom(16).encode('hex'), 16))
+        return '%06x' % self.rand.getrandbits(24)
 
-    @classmethod
-    def from_headers(cls, headers, msg="%(parents)s:%(uid)s %(trace_time)s",
-                     logname='instr.request', uid=_marker, **kwargs):
-        parents = cls.parents(headers)
-        return cls(msg, logname, uid, parents, **kwargs)
+lean_uid = UidSource()
 
-    lognames = 'instr', 'instr.inbound', 'instr.inbound',
 
-    default_formatter = logging.Formatter("%(levelname)-10s %(asctime)s %(message)s")
-    default_handler = logging.StreamHandler(sys.stderr)
+_loggers = {}
 
-    def prepare_outbound(self, headers, **kw):
-        self.extra.update(kw)
-        headers = headers.copy()
-        headers[self.HEADER] = self.make_header()
-        if self.logname is None:
-            headers[self.IGNORE_HEADER] = 'true'
-        return headers
 
-    @classmethod
-    def configure_logs(cls, handler=default_handler, formatter=default_formatter):
-        for name in cls.lognames:
-            logger = logging.getLogger(name)
-            handler.setFormatter(formatter)
-            logger.setHandler(handler)
+def queue_handler(logger, level):
+    """
+    The BackgroundHandler that is the only handler a `level` record
+    from `logger` would reach, with no filters on the way, else None
+    """
+    found = None
+    while logger is not None:
+        if logger.filters:
+            return None
+        for handler in logger.handlers:
+            if level < handler.level:
+                continue
+            if found is not None or type(handler) is not BackgroundHandler or handler.filters:
+                return None
+            found = handler
+        if not logger.propagate:
+            break
+        logger = logger.parent
+    return found
+
+
+def get_logger(name):
+    """
+    logging.getLogger, without taking the logging module lock each time
+    """
+    logger = _loggers.get(name)
+    if logger is None:
+        logger = _loggers[name] = logging.getLogger(name)
+    return logger
+
+
+class LeanTraceProfile(BaseTraceProfile):
+    """
+    Drop in TraceProfile for hot paths: slotted, uids from UidSource
+    rather than md5, no timestamp formatting, and the log message is
+    only assembled when the logger would actually emit it. When a
+    BackgroundHandler is the only handler the record would reach (see
+    configure_logs and queue_handler) the trace is queued for it
+    directly and the LogRecord is built off the request thread.
+    """
+    __slots__ = ('level', 'msg', 'extra', 'uid', 'logname', 'logger',
+                 'origin', 'grandpa', 'parent', 'lineage',
+                 'clock_start_time', 'wall_start_time',
+                 'clock_elapsed', 'wall_elapsed', 'sampled', 'sampler')
+
+    def __init__(self, msg="%(uid)s %(trace_time)s %(parents)s",
+                 logname='monkeylib.instr', uid=_marker, parents=None,
+                 quiet=False, level=logging.DEBUG, sampled=True, sampler=None,
+                 **kwargs):
+        self.level = level
+        self.sampled = sampled
+        self.sampler = sampler or default_sampler
+        self.msg = msg
+        self.extra = kwargs
+        self.uid = uid
+        self.logname = logname
+        self.logger = logname and get_logger(logname) or None
+        self.clock_elapsed = self.wall_elapsed = None
+        origin = grandpa = parent = ''
+        if parents:
+            parents = [x for x in parents if x]
+            if len(parents) == 3:
+                origin, grandpa, parent = parents
+            elif len(parents) == 2:
+                origin, parent = parents
+                grandpa = origin
+            elif parents:
+                origin = grandpa = parent = parents[0]
+        self.origin, self.grandpa, self.parent = origin, grandpa, parent
+        self.lineage = origin, grandpa, parent
+
+    @property
+    def pid(self):
+        return os.getpid()
+
+    uuid_gen = staticmethod(lean_uid)
+
+    def __enter__(self):
+        if self.uid is not None:
+            if self.implicit:
+                self.enter_context()
+            if self.uid is _marker:
+                self.uid = self.uuid_gen()
+        self.clock_start_time = time.clock()
+        self.wall_start_time = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        wall_end = time.time()
+        clock_end = time.clock()
+        self.wall_elapsed = wall_end - self.wall_start_time
+        self.clock_elapsed = clock_end - self.clock_start_time
+        if self.uid is not None and self.implicit:
+            self.exit_context()
+
+        logger = self.logger
+        if logger is None:
+            return False
+
+        extra = self.extra
+        extra['status'] = self.status_for(exc_type) or extra.get('status', 0)
+        if not self.sampler.keep(self):
+            return False
+        for recorder in self.recorders:
+            recorder(self)
+
+        if logger.isEnabledFor(self.level):
+            extra['uid'] = self.uid
+            extra['parents'] = "%s:%s" %(self.origin, self.parent)
+            extra['clock_time'] = self.clock_elapsed
+            extra['wall_time'] = self.wall_elapsed
+            emitter = queue_handler(logger, self.level)
+            if emitter is not None:
+                emitter.put((logger, self.level, self.msg, extra, wall_end))
+            else:
+                # makeRecord directly: skips logging's findCaller stack walk
+                logger.handle(logger.makeRecord(logger.name, self.level, __file__, 0,
+                                                self.msg, (extra,), None, None, extra))
+        return False
+
+
+class LatencyRecorder(object):
+    """
+    In-memory latency histograms per path (or logname, for traces
+    without one), for scraping live percentiles.
+
+    Usable as a trace recorder (TraceProfile.add_recorder) or passed to
+    logging_timer_mw as `latency`. Values go into the current window;
+    every `period` seconds it becomes the previous window and a fresh
+    one starts. Recording, rotation and reading the current window
+    share a lock, since KeyedHistograms reshuffles its keys as paths
+    come and go; at most `top` paths are kept per window.
+    """
+
+    def __init__(self, period=60, top=200):
+        self.period = period
+        self.top = top
+        self.lock = threading.Lock()
+        self.previous = None
+        self.previous_start = None
+        self.current = KeyedHistograms(top)
+        self.current_start = time.time()
+
+    def rotate(self, now):
+        # called with the lock held
+        if now - self.current_start < self.period:
+            return
+        self.previous, self.previous_start = self.current, self.current_start
+        self.current, self.current_start = KeyedHistograms(self.top), now
+
+    def __call__(self, profile):
+        self.record(profile.extra.get('path') or profile.logname, profile.wall_elapsed)
+
+    def record(self, key, wall_time):
+        with self.lock:
+            self.rotate(time.time())
+            self.current.add(key, wall_time)
+
+    @staticmethod
+    def summary(hists, start):
+        if hists is None:
+            return None
+        paths = {}
+        for key, hist in hists.items():
+            if not hist.count:
+                continue
+            paths[key] = dict(count=hist.count,
+                              mean=hist.mean,
+                              max=hist.max,
+                              p50=hist.percentile(0.5),
+                              p90=hist.percentile(0.9),
+                              p99=hist.percentile(0.99))
+        return dict(start=start, paths=paths)
+
+    def snapshot(self):
+        """
+        Percentiles (in seconds) and counts for the current and
+        previous windows
+        """
+        with self.lock:
+            self.rotate(time.time())
+            current = self.summary(self.current, self.current_start)
+            previous, previous_start = self.previous, self.previous_start
+        # a rotated window is no longer written to
+        return dict(period=self.period,
+                    current=current,
+                    previous=self.summary(previous, previous_start))
+
+    @wsgify
+    def app(self, req):
+        """
+        WSGI app serving `snapshot` as json
+        """
+        return Response(json.dumps(self.snapshot()), content_type='application/json')
 
 
 trace_blacklist = ['/']
 trace_prefix_blacklist = ['_status', 'hax', 'pid', '_baboon', 'js', 'css', 'img']
 
 
+class PathMatcher(object):
+    """
+    Decide per path whether (and at which level) to trace a request.
+
+    Rules are (pattern, action) pairs. Patterns are '/' separated
+    segments where '*' matches any one segment and a trailing '**'
+    matches zero or more; the action is 'exclude', 'include' (at the
+    default level) or a logging level name. The rules are built into a
+    trie of segments once, so matching costs a dict lookup per path
+    segment however many rules there are, plus backtracking where a
+    literal branch dead ends and '*' is tried instead.
+
+    Where several rules match, segments are compared from the left and
+    the first one that differs decides: a literal beats '*', which
+    beats a '**' covering that segment. So '/a/b/** INFO' wins over
+    '/a/*/c exclude' for /a/b/c. A rule ending at the path's last
+    segment beats a '**' there.
+    """
+    _unset = object()
+
+    class Node(object):
+        __slots__ = ('children', 'star', 'end', 'rest')
+
+        def __init__(self):
+            self.children = {}
+            self.star = None
+            self.end = self.rest = PathMatcher._unset
+
+    _compiled = {}
+
+    def __init__(self, rules=(), default=logging.DEBUG):
+        self.default = default
+        self.root = self.Node()
+        for pattern, action in rules:
+            self.add(pattern, action)
+
+    def action_level(self, action):
+        if action == 'exclude':
+            return None
+        if action == 'include':
+            return self.default
+        level = logging.getLevelName(action.upper())
+        if not isinstance(level, int):
+            raise ValueError("Unknown trace rule action %r" %action)
+        return level
+
+    def add(self, pattern, action):
+        level = self.action_level(action)
+        segments = [x for x in pattern.strip('/').split('/') if x]
+        node = self.root
+        for i, segment in enumerate(segments):
+            if segment == '**':
+                if i != len(segments) - 1:
+                    raise ValueError("'**' must end the pattern: %s" %pattern)
+                node.rest = level
+                return
+            if segment == '*':
+                if node.star is None:
+                    node.star = self.Node()
+                node = node.star
+            else:
+                node = node.children.setdefault(segment, self.Node())
+        node.end = level
+
+    def match(self, path):
+        """
+        Log level to trace `path` at, or None to leave it untraced
+        """
+        segments = [x for x in path.strip('/').split('/') if x]
+        level = self.search(self.root, segments, 0)
+        if level is self._unset:
+            return self.default
+        return level
+
+    def search(self, node, segments, i):
+        """
+        Level of the most specific rule under `node` matching
+        segments[i:], depth first: the literal branch, then '*', then
+        the node's own '**'
+        """
+        unset = self._unset
+        if i == len(segments):
+            if node.end is not unset:
+                return node.end
+            return node.rest
+        child = node.children.get(segments[i])
+        if child is not None:
+            level = self.search(child, segments, i + 1)
+            if level is not unset:
+                return level
+        if node.star is not None:
+            level = self.search(node.star, segments, i + 1)
+            if level is not unset:
+                return level
+        return node.rest
+
+    @classmethod
+    def from_config(cls, text, default=logging.DEBUG):
+        """
+        Rules from text, one 'pattern action' pair per line:
+
+            /             exclude
+            /_status/**   exclude
+            /api/**       INFO
+        """
+        rules = []
+        for line in text.splitlines():
+            line = line.split('#', 1)[0].strip()
+            if line:
+                pattern, action = line.split()
+                rules.append((pattern, action))
+        return cls(rules, default)
+
+    @classmethod
+    def compile(cls, text, default=logging.DEBUG):
+        """
+        from_config, memoized per rule text
+        """
+        key = text, default
+        matcher = cls._compiled.get(key)
+        if matcher is None:
+            matcher = cls._compiled[key] = cls.from_config(text, default)
+        return matcher
+
+    @classmethod
+    def from_blacklists(cls, exclude=trace_blacklist, exclude_prefix=trace_prefix_blacklist,
+                        default=logging.DEBUG):
+        rules = [(x, 'exclude') for x in exclude]
+        rules.extend(('/%s/**' %x, 'exclude') for x in exclude_prefix)
+        return cls(rules, default)
+
+
 @wsgify.middleware
 def logging_timer_mw(req, app, logname='instr.inbound',\
                      exclude=frozenset(trace_blacklist),
-                     exclude_prefix=frozenset(trace_prefix_blacklist)):
-    exclude = req.path_info_peek() in exclude_prefix or req.path in exclude
-    if exclude or req.headers.get(TraceProfile.IGNORE_HEADER):
+                     exclude_prefix=frozenset(trace_prefix_blacklist),
+                     profile=TraceProfile, latency=None,
+                     latency_path='/_status/latency', sampler=None,
+                     matcher=None, profiler=None):
+    """
+    Time and log each request. `profile` may be LeanTraceProfile for
+    lower per-request overhead, and `sampler` a TraceSampler limiting
+    how many requests are logged.
+
+    matcher
+
+       a PathMatcher, or its rules as text (see
+       PathMatcher.from_config), deciding by path_info which requests
+       are traced and at what level; replaces exclude and
+       exclude_prefix
+
+    latency
+
+       a LatencyRecorder to record traced requests into; its
+       percentiles are served as json at `latency_path`
+
+    profiler
+
+       a stackprof.SlowRequestProfiler sampling traced requests and
+       keeping the stacks of slow ones
+    """
+    if latency is not None and req.path == latency_path:
+        return req.get_response(latency.app)
+    level = logging.DEBUG
+    if matcher is not None:
+        if isinstance(matcher, basestring):
+            matcher = PathMatcher.compile(matcher)
+        level = matcher.match(req.path_info)
+        exclude = level is None
+    else:
+        exclude = req.path_info_peek() in exclude_prefix or req.path in exclude
+    if exclude or req.headers.get(profile.IGNORE_HEADER):
         logname = None
-    with TraceProfile.from_headers(req.headers,
-                                   msg="%(parents)s:%(uid)s %(wall_time)f %(path)s %(status)s",
-                                   logname=logname, path=req.path) as prof:
-        req.environ['monkey.profile'] = prof
-        req.environ['request.uid'] = prof.uid
-        resp = req.get_response(app)
-        prof.extra['status'] = resp.status_int
+    prof = None
+    profiling = profiler is not None and logname is not None
+    if profiling:
+        profiler.start()
+    try:
+        with profile.from_headers(req.headers,
+                                  msg="%(parents)s:%(uid)s %(wall_time)f %(path)s %(status)s",
+                                  logname=logname, sampler=sampler, level=level or logging.DEBUG,
+                                  path=req.path) as prof:
+            req.environ['monkey.profile'] = prof
+            req.environ['request.uid'] = prof.uid
+            resp = req.get_response(app)
+            prof.extra['status'] = resp.status_int
+    finally:
+        if profiling:
+            profiler.finish(prof)
+    if latency is not None and logname is not None:
+        latency(prof)
     return resp
 
 
+class TimedFooter(object):
+    """
+    app_iter passing a body through chunk by chunk, then appending a
+    rule as wide as its longest line and the time from `start_time`
+    to the last body chunk
+    """
+
+    def __init__(self, app_iter, start_time):
+        self.app_iter = app_iter
+        self.start_time = start_time
+
+    def __iter__(self):
+        width = current = 0
+        for chunk in self.app_iter:
+            if chunk:
+                lines = chunk.split('\n')
+                if len(lines) == 1:
+                    current += len(chunk)
+                else:
+                    width = max(width, current + len(lines[0]), *[len(x) for x in lines[1:-1]])
+                    current = len(lines[-1])
+            yield chunk
+        time_passed = time.time() - self.start_time
+        width = max(width, current)
+        yield "\n%s\nserved in %.5f seconds\n" %("-" * width, time_passed)
+
+    def close(self):
+        if hasattr(self.app_iter, 'close'):
+            self.app_iter.close()
+
+
 @wsgify.middleware
 def append_time_mw(req, app):
+    """
+    Append the time taken to serve text/plain responses. The body is
+    streamed through (see TimedFooter) rather than buffered, so the
+    time covers producing the whole body; as the footer's length isn't
+    known up front, Content-Length is dropped.
+    """
     start_time = time.time()
     resp = req.get_response(app)
-    if not resp.headers['Content-type'] == "text/plain":
+    if resp.content_type != "text/plain":
         # bail out
         return resp
-    end = time.time()
-    time_passed = (end - start_time) 
-    msg = "served in %.5f seconds" % time_passed
-
-    slen = max(len(x) for x in resp.body.split('\n'))
-    print >> resp, ''
-    print >> resp, "-"*slen
-    print >> resp, msg
+    resp.app_iter = TimedFooter(resp.app_iter, start_time)
+    resp.content_length = None
     return resp
 
 
@@ -246,6 +1028,8 @@ Timer = partial(TraceProfile, uid=None, logname=None) # defanged
                                                       # good for
                                                       # simple timing
 
+LeanTimer = partial(LeanTraceProfile, uid=None, logname=None)
+
 @contextmanager
 def null_trace_cm():
     """
@@ -0,0 +1,99 @@
+"""
+Constant memory access to (possibly very large) log files.
+"""
+import mmap
+import os
+
+
+class LogReader(object):
+    """
+    Iterate the lines of a log file through a read only memory map.
+
+    Only the lines *starting* inside the byte range [start, end) are
+    produced, so adjacent ranges (see `chunk_ranges`) never share or
+    split a line. After iteration, `offset` is the byte position just
+    past the last complete (newline terminated) line read, suitable for
+    resuming later.
+
+    whole_lines
+
+       skip a trailing line that has no newline yet (it may still be
+       being written)
+    """
+
+    def __init__(self, filename, start=0, end=None, whole_lines=False):
+        self.filename = filename
+        self.start = start
+        self.end = end
+        self.whole_lines = whole_lines
+        self.offset = start
+        self.lines = 0
+
+    def __iter__(self):
+        with open(self.filename, 'rb') as fh:
+            size = os.fstat(fh.fileno()).st_size
+            end = size
+            if self.end is not None:
+                end = min(self.end, size)
+            if self.start >= end:
+                return
+            mm = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                pos = line_start(mm, self.start)
+                mm.seek(pos)
+                readline = mm.readline
+                while pos < end:
+                    line = readline()
+                    if not line:
+                        break
+                    if not line.endswith('\n'):
+                        if self.whole_lines:
+                            break
+                        self.lines += 1
+                        yield line
+                        break
+                    pos += len(line)
+                    self.offset = pos
+                    self.lines += 1
+                    yield line
+            finally:
+                mm.close()
+
+
+def line_start(mm, pos):
+    """
+    First line boundary at or after `pos`
+    """
+    if pos <= 0:
+        return 0
+    if mm[pos - 1] == '\n':
+        return pos
+    nl = mm.find('\n', pos)
+    if nl == -1:
+        return len(mm)
+    return nl + 1
+
+
+def first_line(filename, size=256):
+    """
+    The file's first line if it is complete within `size` bytes, else
+    ''; with the inode, tells a log apart from one rotated into its
+    place
+    """
+    with open(filename, 'rb') as fh:
+        head = fh.read(size)
+    if '\n' not in head:
+        return ''
+    return head.split('\n', 1)[0]
+
+
+def chunk_ranges(filename, chunk_bytes=64 * 1024 * 1024):
+    """
+    Split a file into (start, end) byte ranges of roughly `chunk_bytes`
+    for LogReader; safe to hand to separate workers.
+    """
+    size = os.path.getsize(filename)
+    if not size:
+        return []
+    return [(start, min(start + chunk_bytes, size))
+            for start in xrange(0, size, chunk_bytes)]
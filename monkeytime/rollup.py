@@ -0,0 +1,171 @@
+"""
+Persistent, incrementally updated interval statistics.
+
+A RollupStore keeps a histogram per fixed `resolution` second bucket
+(and per key, when built with `by`) in a sqlite file, and remembers how
+far into each log file it has read. Updating only parses bytes
+appended since the last run; queries for any multiple of the
+resolution are answered from the stored histograms without touching
+the raw logs.
+"""
+from itertools import groupby
+from monkeytime.analyze import bucket_floor
+from monkeytime.analyze import epoch_timestamp
+from monkeytime.analyze import generate_perf_info
+from monkeytime.analyze import group_key
+from monkeytime.analyze import interval_stats
+from monkeytime.analyze import log_files
+from monkeytime.analyze import open_log
+from monkeytime.histogram import KeyedHistograms
+from monkeytime.histogram import LatencyHistogram
+from monkeytime.logreader import first_line
+import json
+import os
+import sqlite3
+
+
+class RollupStore(object):
+    """
+    sqlite backed store of per-interval histograms
+
+    resolution
+
+       seconds per stored bucket; queries may use any multiple of it
+
+    by, top
+
+       as for analyze.groups; fixed for the life of the store
+    """
+    schema = """
+    create table if not exists meta (
+        name text primary key,
+        value text);
+    create table if not exists files (
+        dev integer,
+        ino integer,
+        head text,
+        name text,
+        offset integer,
+        primary key (dev, ino));
+    create table if not exists buckets (
+        start integer,
+        key text,
+        state text,
+        primary key (start, key));
+    """
+    headsize = 256
+
+    def __init__(self, filename, resolution=None, by=None, top=None):
+        self.filename = filename
+        self.db = sqlite3.connect(filename)
+        # keys and file heads are log bytes, not necessarily ascii
+        self.db.text_factory = str
+        self.db.executescript(self.schema)
+        self.resolution = int(self.setting('resolution', resolution, 60))
+        self.by = self.setting('by', by)
+        self.top = top
+        self.keyfunc = group_key(self.by)
+
+    def setting(self, name, value, default=None):
+        """
+        Stored value for `name`, recording `value` (or `default`) if
+        there isn't one yet. A conflicting value is an error.
+        """
+        row = self.db.execute("select value from meta where name = ?", (name,)).fetchone()
+        if row is None:
+            if value is None:
+                value = default
+            self.db.execute("insert into meta values (?, ?)", (name, json.dumps(value)))
+            self.db.commit()
+            return value
+        stored = json.loads(row[0])
+        if value is not None and stored != value:
+            raise ValueError("%s was created with %s=%r, not %r"
+                             %(self.filename, name, stored, value))
+        return stored
+
+    def close(self):
+        self.db.close()
+
+    def update(self, logdir, pattern="perf.log*", **filters):
+        """
+        Parse whatever is new in the rotated logs in `logdir`; returns
+        the number of lines read
+        """
+        return sum(self.update_file(logfile, **filters)
+                   for logfile in log_files(logdir, pattern))
+
+    def update_file(self, logfile, **filters):
+        stat = os.stat(logfile)
+        head = first_line(logfile, self.headsize)
+        offset = 0
+        row = self.db.execute("select head, offset from files where dev = ? and ino = ?",
+                              (stat.st_dev, stat.st_ino)).fetchone()
+        if row is not None:
+            known_head, known_offset = row
+            same = not known_head or known_head == head
+            if same and known_offset <= stat.st_size:
+                offset = known_offset
+
+        if offset == stat.st_size:
+            return 0
+
+        reader = open_log(logfile, start=offset, whole_lines=True)
+        buckets = {}
+        keyfunc = self.keyfunc
+        resolution = self.resolution
+        marker = object()
+        for uid, info, blob in generate_perf_info(reader, marker=marker, **filters):
+            if uid is marker:
+                break
+            start = bucket_floor(info.dt, resolution)
+            hists = buckets.get(start)
+            if hists is None:
+                hists = buckets[start] = KeyedHistograms(self.top)
+            hists.add(keyfunc and keyfunc(info), info.howlong)
+
+        for start, hists in buckets.iteritems():
+            self.merge_bucket(start, hists)
+        self.db.execute("insert or replace into files values (?, ?, ?, ?, ?)",
+                        (stat.st_dev, stat.st_ino, head, str(logfile), reader.offset))
+        self.db.commit()
+        return reader.lines
+
+    def load_bucket(self, start):
+        hists = KeyedHistograms(self.top)
+        for key, state in self.db.execute("select key, state from buckets where start = ?",
+                                          (start,)):
+            hists.hists[key or None] = LatencyHistogram.from_state(json.loads(state))
+        return hists
+
+    def merge_bucket(self, start, hists):
+        stored = self.load_bucket(start).merge(hists)
+        self.db.execute("delete from buckets where start = ?", (start,))
+        self.db.executemany("insert into buckets values (?, ?, ?)",
+                            [(start, key or '', json.dumps(hist.to_state()))
+                             for key, hist in stored.hists.iteritems()])
+
+    def query(self, interval=None, start=None, end=None):
+        """
+        Yield (start epoch, KeyedHistograms) for each `interval` second
+        bucket between epochs `start` and `end`, oldest first
+        """
+        interval = interval or self.resolution
+        if interval % self.resolution:
+            raise ValueError("interval must be a multiple of %d" %self.resolution)
+        sql = "select start, key, state from buckets where start >= ? and start < ? order by start"
+        rows = self.db.execute(sql, (start or 0, end or 2 ** 62))
+        for bucket, group in groupby(rows, lambda row: row[0] - row[0] % interval):
+            hists = KeyedHistograms(self.top)
+            for ts, key, state in group:
+                hists.histogram(key or None).merge(LatencyHistogram.from_state(json.loads(state)))
+            yield bucket, hists
+
+    def stats(self, interval=None, start=None, end=None):
+        """
+        statdicts, as from analyze.yield_stats, for stored buckets
+        """
+        interval = interval or self.resolution
+        for bucket, hists in self.query(interval, start, end):
+            for info in interval_stats(hists, epoch_timestamp(bucket), interval, self.by):
+                yield info
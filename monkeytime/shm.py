@@ -0,0 +1,228 @@
+"""
+Host-wide live latency histograms in shared memory.
+
+Pre-forked workers each record into their own slot of a fixed-layout,
+memory mapped file (put it on /dev/shm), and recording is a few
+in-place increments: no locks between processes and no log I/O. A
+reader in any process maps the same file and merges every slot into
+per-route histograms.
+
+The increments are not atomic, so this is exact for single threaded
+workers only, where each slot has a single writer. Threads of one
+worker share its slot and may occasionally lose an update to another.
+
+    region = SharedHistograms('/dev/shm/monkeytime')
+    TraceProfile.add_recorder(region)           # in each worker
+    monkeytime-analyze shm /dev/shm/monkeytime  # anywhere on the host
+
+Layout: a header, then `slots` slots, each a pid and `routes` route
+entries of a name, count, sum, sum of squares, min, max and log-scale
+bins (as LatencyHistogram's, at `accuracy`) covering `min_value` up to
+`max_value` seconds. Figures are cumulative since the file was
+created; a slot left by a dead worker is taken over, totals and all,
+by the next worker to claim one. Once a slot's route entries are all
+named, further routes are counted under OTHER (the first entry).
+"""
+from monkeytime.histogram import KeyedHistograms
+from monkeytime.histogram import LatencyHistogram
+from monkeytime.instr import LatencyRecorder
+from webob import Response
+from webob.dec import wsgify
+import ctypes
+import errno
+import fcntl
+import json
+import math
+import mmap
+import os
+import struct
+
+MAGIC = 'MTSH'
+HEADER = struct.Struct('<4sIIIIdd')
+HEADER_SIZE = 64
+NAME_SIZE = 64
+
+
+def layout(slots, routes, nbins):
+    """
+    ctypes array of slots for the given dimensions
+    """
+    class Route(ctypes.Structure):
+        _fields_ = [('name', ctypes.c_char * NAME_SIZE),
+                    ('count', ctypes.c_uint64),
+                    ('total', ctypes.c_double),
+                    ('squares', ctypes.c_double),
+                    ('min', ctypes.c_double),
+                    ('max', ctypes.c_double),
+                    ('below', ctypes.c_uint64),
+                    ('bins', ctypes.c_uint32 * nbins)]
+
+    class Slot(ctypes.Structure):
+        _fields_ = [('pid', ctypes.c_int64),
+                    ('routes', Route * routes)]
+
+    return Slot * slots
+
+
+def alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError, e:
+        return e.errno == errno.EPERM
+    return True
+
+
+class SharedHistograms(object):
+    """
+    A shared histogram region in `filename`, created with the given
+    dimensions if it doesn't exist (an existing file keeps its own)
+    """
+    OTHER = KeyedHistograms.OTHER
+
+    def __init__(self, filename, slots=32, routes=128, accuracy=0.02,
+                 min_value=1e-5, max_value=100.0):
+        self.filename = filename
+        self.fh = open(filename, 'a+b')
+        self.opener = os.getpid()
+        fcntl.flock(self.fh, fcntl.LOCK_EX)
+        try:
+            self.fh.seek(0)
+            head = self.fh.read(HEADER.size)
+            if len(head) < HEADER.size:
+                lngamma = math.log((1 + accuracy) / (1 - accuracy))
+                nbins = int(math.ceil(math.log(max_value / min_value) / lngamma)) + 1
+                head = HEADER.pack(MAGIC, 1, slots, routes, nbins, accuracy, min_value)
+                size = HEADER_SIZE + ctypes.sizeof(layout(slots, routes, nbins))
+                self.fh.truncate(0)
+                self.fh.write(head)
+                self.fh.flush()
+                os.ftruncate(self.fh.fileno(), size)
+        finally:
+            fcntl.flock(self.fh, fcntl.LOCK_UN)
+
+        magic, version, slots, routes, nbins, accuracy, min_value = HEADER.unpack(head)
+        if magic != MAGIC:
+            raise ValueError("%s is not a shared histogram region" %filename)
+        self.nslots, self.nroutes, self.nbins = slots, routes, nbins
+        self.accuracy = accuracy
+        self.lngamma = math.log((1 + accuracy) / (1 - accuracy))
+        self.offset = int(math.ceil(math.log(min_value) / self.lngamma))
+        self.min_value = min_value
+        self.mm = mmap.mmap(self.fh.fileno(), 0)
+        self.slots = layout(slots, routes, nbins).from_buffer(self.mm, HEADER_SIZE)
+        self.pid = None
+        self.slot = None
+        self.entries = {}
+
+    def claim(self):
+        """
+        Take a free slot (or one left by a dead process) for this
+        process
+        """
+        pid = os.getpid()
+        if self.opener != pid:
+            # a descriptor inherited across fork shares its flock with
+            # the parent and siblings, so it can't exclude them
+            self.fh.close()
+            self.fh = open(self.filename, 'a+b')
+            self.opener = pid
+        fcntl.flock(self.fh, fcntl.LOCK_EX)
+        try:
+            for slot in self.slots:
+                if slot.pid == pid or not slot.pid or not alive(slot.pid):
+                    slot.pid = pid
+                    break
+            else:
+                raise ValueError("All %d slots of %s are in use" %(self.nslots, self.filename))
+        finally:
+            fcntl.flock(self.fh, fcntl.LOCK_UN)
+        self.pid, self.slot = pid, slot
+        if not slot.routes[0].name:
+            # reserved for routes beyond the table
+            slot.routes[0].name = self.OTHER
+        self.entries = dict((route.name, route) for route in slot.routes if route.name)
+
+    def entry(self, name):
+        if isinstance(name, unicode):
+            name = name.encode('utf-8')
+        name = (name or self.OTHER)[:NAME_SIZE - 1]
+        route = self.entries.get(name)
+        if route is not None:
+            return route
+        for route in self.slot.routes:
+            if not route.name:
+                route.name = name
+                self.entries[name] = route
+                return route
+        return self.entries[self.OTHER]
+
+    def record(self, name, seconds):
+        if self.pid != os.getpid():
+            self.claim()
+        route = self.entry(name)
+        if seconds > self.min_value:
+            idx = int(math.ceil(math.log(seconds) / self.lngamma)) - self.offset
+            route.bins[min(idx, self.nbins - 1)] += 1
+        else:
+            route.below += 1
+        if not route.count or seconds < route.min:
+            route.min = seconds
+        if seconds > route.max:
+            route.max = seconds
+        route.total += seconds
+        route.squares += seconds * seconds
+        route.count += 1
+
+    def __call__(self, profile):
+        """
+        Trace recorder, keyed like LatencyRecorder
+        """
+        self.record(profile.extra.get('path') or profile.logname, profile.wall_elapsed)
+
+    def histogram(self, route):
+        hist = LatencyHistogram(accuracy=self.accuracy)
+        count = route.count
+        if not count:
+            return hist
+        offset = self.offset
+        hist.bins = dict((idx + offset, num) for idx, num in enumerate(route.bins) if num)
+        hist.zeros = route.below
+        hist.count = count
+        hist.mean = route.total / count
+        hist.m2 = max(route.squares - route.total * route.total / count, 0.0)
+        hist.min, hist.max = route.min, route.max
+        return hist
+
+    def snapshot(self):
+        """
+        KeyedHistograms of every slot merged by route
+        """
+        merged = KeyedHistograms(accuracy=self.accuracy)
+        for slot in self.slots:
+            if not slot.pid:
+                continue
+            for route in slot.routes:
+                if route.name and route.count:
+                    merged.histogram(route.name).merge(self.histogram(route))
+        return merged
+
+    def workers(self):
+        return [slot.pid for slot in self.slots if slot.pid and alive(slot.pid)]
+
+    def summary(self):
+        info = LatencyRecorder.summary(self.snapshot(), None)
+        info['workers'] = self.workers()
+        return info
+
+    @wsgify
+    def app(self, req):
+        """
+        WSGI app serving `summary` as json
+        """
+        return Response(json.dumps(self.summary()), content_type='application/json')
+
+    def close(self):
+        self.slots = self.slot = None
+        self.entries = {}
+        self.mm.close()
+        self.fh.close()
@@ -0,0 +1,152 @@
+"""
+Statistical stack sampling for slow requests.
+
+A single background thread wakes every `interval` seconds and, for each
+thread currently serving a watched request, records its stack (from
+sys._current_frames) as one collapsed line, root first:
+
+    handle (app.py:10);search (search.py:40);query (db.py:120) 17
+
+Nothing is sampled between requests. When a request finishes, its
+samples are written out, named by trace uid, only if it was slow or
+CPU bound; otherwise they are dropped. The collapsed format feeds
+flamegraph.pl and similar tools directly.
+
+    profiler = SlowRequestProfiler(threshold=0.5, directory='/var/log/profiles')
+    app = logging_timer_mw(app, profiler=profiler)
+
+Under gevent every greenlet shares its OS thread's frame, so samples
+show whichever greenlet was running.
+"""
+import os
+import sys
+import thread
+import threading
+import time
+
+
+def collapse(frame, maxdepth=64):
+    """
+    Collapsed stack line for `frame`, outermost call first
+    """
+    names = []
+    while frame is not None and len(names) < maxdepth:
+        code = frame.f_code
+        names.append("%s (%s:%d)" %(code.co_name, os.path.basename(code.co_filename),
+                                    code.co_firstlineno))
+        frame = frame.f_back
+    names.reverse()
+    return ";".join(names)
+
+
+class StackSampler(object):
+    """
+    Samples the stacks of watched threads every `interval` seconds
+    """
+
+    def __init__(self, interval=0.005, maxdepth=64):
+        self.interval = interval
+        self.maxdepth = maxdepth
+        self.watched = {}
+        self.lock = threading.Lock()
+        self.thread = None
+        self.pid = None
+        self.samples = 0
+
+    def start(self):
+        with self.lock:
+            if self.thread is not None and self.pid == os.getpid():
+                return
+            # (re)started lazily, so a pre-forking server gets one per worker
+            self.pid = os.getpid()
+            self.thread = threading.Thread(target=self.run, name='monkeytime.stackprof')
+            self.thread.daemon = True
+            self.thread.start()
+
+    def watch(self, ident=None):
+        """
+        Start sampling thread `ident` (the calling thread by default)
+        """
+        if self.pid != os.getpid():
+            self.start()
+        self.watched[ident or thread.get_ident()] = {}
+
+    def unwatch(self, ident=None):
+        """
+        Stop sampling a thread; returns its {collapsed stack: count}
+        """
+        # copied in one step, the sampler may still hold the original
+        return dict(self.watched.pop(ident or thread.get_ident(), {}))
+
+    def run(self):
+        me = thread.get_ident()
+        while True:
+            time.sleep(self.interval)
+            if not self.watched:
+                continue
+            frames = sys._current_frames()
+            for ident, counts in self.watched.items():
+                frame = frames.get(ident)
+                if frame is None or ident == me:
+                    continue
+                stack = collapse(frame, self.maxdepth)
+                counts[stack] = counts.get(stack, 0) + 1
+                self.samples += 1
+
+
+class SlowRequestProfiler(object):
+    """
+    Keeps a request's samples only if it ran for `threshold` seconds
+    or more, or (given a `cpu_ratio`) if it ran for at least `min_wall`
+    seconds with clock_time / wall_time at or above `cpu_ratio`.
+
+    time.clock is process wide, so the ratio is only meaningful for
+    servers running one request per process at a time.
+
+    directory
+
+       where <uid>.collapsed files are written
+    """
+
+    def __init__(self, threshold=1.0, cpu_ratio=None, min_wall=0.1, directory='profiles',
+                 sampler=None):
+        self.threshold = threshold
+        self.cpu_ratio = cpu_ratio
+        self.min_wall = min_wall
+        self.directory = directory
+        self.sampler = sampler or StackSampler()
+        self.captured = 0
+        self.skipped = 0
+
+    def start(self):
+        self.sampler.watch()
+
+    def slow(self, profile):
+        wall = profile.wall_elapsed
+        if wall >= self.threshold:
+            return True
+        if self.cpu_ratio is None or wall < self.min_wall or not wall:
+            return False
+        return profile.clock_elapsed / wall >= self.cpu_ratio
+
+    def finish(self, profile):
+        """
+        Stop sampling the calling thread, saving its samples if the
+        finished `profile` qualifies; returns the filename or None
+        """
+        counts = self.sampler.unwatch()
+        if profile is None or not counts or not self.slow(profile):
+            self.skipped += 1
+            return None
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        filename = os.path.join(self.directory, "%s.collapsed" %profile.uid)
+        with open(filename, 'w') as out:
+            for stack, num in sorted(counts.iteritems()):
+                out.write("%s %d\n" %(stack, num))
+        self.captured += 1
+        return filename
+
+    def stats(self):
+        return dict(captured=self.captured, skipped=self.skipped,
+                    samples=self.sampler.samples)
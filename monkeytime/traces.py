@@ -0,0 +1,203 @@
+"""
+Cross-service request trees.
+
+Each service logs its inbound requests as origin:parent:uid, where
+parent is the uid of the upstream request that made the call and origin
+the uid of the request at the root of the tree (empty on the root
+itself). TraceIndex joins the records of any number of services' logs
+into per-origin trees as they stream past, holding only the trees still
+open: a tree is complete once its origin has gone `span` seconds of log
+time without a new record.
+
+    monkeytime-analyze traces -p '*.log*' -o traces.csv logdir
+"""
+from collections import OrderedDict
+from monkeytime.analyze import generate_perf_info
+from monkeytime.analyze import log_files
+from monkeytime.analyze import open_log
+from monkeytime.histogram import KeyedHistograms
+from operator import attrgetter
+import calendar
+import heapq
+
+get_howlong = attrgetter('howlong')
+
+
+def epoch(dt):
+    return calendar.timegm(dt.timetuple()) + dt.microsecond / 1e6
+
+
+class TraceTree(object):
+    """
+    The records sharing an origin, joined by parent uid
+    """
+
+    def __init__(self, origin):
+        self.origin = origin
+        self.records = {}
+        self.children = {}
+        self.last = 0
+
+    def __len__(self):
+        return len(self.records)
+
+    def add(self, info):
+        self.records[info.uid] = info
+        if info.parent and info.parent != info.uid:
+            self.children.setdefault(info.parent, []).append(info)
+
+    @property
+    def root(self):
+        return self.records.get(self.origin)
+
+    def critical_path(self, info=None):
+        """
+        The chain of slowest calls down from the root (or `info`), as
+        (PerfInfo, exclusive seconds) pairs: each record's own latency
+        less that of the next call on the path
+        """
+        node = info or self.root
+        path = []
+        seen = set()
+        while node is not None and node.uid not in seen:
+            seen.add(node.uid)
+            calls = self.children.get(node.uid)
+            slowest = calls and max(calls, key=get_howlong) or None
+            exclusive = node.howlong - (slowest and slowest.howlong or 0)
+            path.append((node, max(exclusive, 0.0)))
+            node = slowest
+        return path
+
+    def __repr__(self):
+        return "<%s %s records=%d>" % (self.__class__.__name__, self.origin, len(self.records))
+
+
+class TraceIndex(object):
+    """
+    Streaming join of records into TraceTrees
+
+    span
+
+       seconds of log time after its latest record before a tree is
+       considered complete
+
+    maxopen
+
+       most trees held at once; beyond it the stalest are handed back
+       early
+    """
+
+    def __init__(self, span=300, maxopen=100000):
+        self.span = span
+        self.maxopen = maxopen
+        # origin -> TraceTree, least recently touched first
+        self.open = OrderedDict()
+        self.latest = 0
+
+    def __len__(self):
+        return len(self.open)
+
+    def add(self, info):
+        """
+        Index a record; returns any trees it completes
+        """
+        when = epoch(info.dt)
+        origin = info.origin or info.uid
+        tree = self.open.pop(origin, None)
+        if tree is None:
+            tree = TraceTree(origin)
+        self.open[origin] = tree
+        tree.add(info)
+        if when > tree.last:
+            tree.last = when
+        if when > self.latest:
+            self.latest = when
+        return self.expire(self.latest - self.span)
+
+    def expire(self, upto):
+        """
+        Hand back trees last touched by epoch `upto`
+        """
+        done = []
+        trees = self.open
+        while trees:
+            origin, tree = next(trees.iteritems())
+            if tree.last > upto and len(trees) <= self.maxopen:
+                break
+            done.append(trees.popitem(last=False)[1])
+        return done
+
+    def flush(self):
+        done = self.open.values()
+        self.open = OrderedDict()
+        return done
+
+
+class CriticalPathReport(object):
+    """
+    Critical path latency per root uri, and the downstream uris that
+    spend the most of it (their exclusive time on the path)
+    """
+
+    def __init__(self, top=None):
+        self.top = top
+        self.latency = KeyedHistograms(top)
+        self.contributors = {}
+        self.orphans = 0
+
+    def add(self, tree):
+        root = tree.root
+        if root is None:
+            # the root request was never logged, or logged out of span
+            self.orphans += 1
+            return
+        self.latency.add(root.uri, root.howlong)
+        hists = self.contributors.get(root.uri)
+        if hists is None:
+            hists = self.contributors[root.uri] = KeyedHistograms(self.top)
+        for info, exclusive in tree.critical_path()[1:]:
+            hists.add(info.uri, exclusive)
+
+    def rows(self):
+        """
+        A dict per root uri and contributor, biggest contributors first
+        (times in ms)
+        """
+        for uri, hist in self.latency.items():
+            info = dict(uri=uri, traces=hist.count,
+                        mean=hist.mean * 1000,
+                        p99th=hist.percentile(0.99) * 1000)
+            hists = self.contributors.get(uri)
+            total = hist.mean * hist.count
+            contributors = hists and sorted(hists.hists.iteritems(), reverse=True,
+                                            key=lambda item: item[1].mean * item[1].count)
+            if not contributors:
+                yield dict(info, contributor='', calls=0, contributor_mean=0, share=0)
+                continue
+            for key, chist in contributors:
+                spent = chist.mean * chist.count
+                yield dict(info, contributor=key, calls=chist.count,
+                           contributor_mean=chist.mean * 1000,
+                           share=total and spent / total or 0)
+
+
+def timed_records(logfile, **filters):
+    marker = object()
+    for uid, info, blob in generate_perf_info(open_log(logfile), marker=marker, **filters):
+        if uid is not marker:
+            yield info.dt, info
+
+
+def trace_trees(logdir, pattern="perf.log*", span=300, maxopen=100000, **filters):
+    """
+    Yield the TraceTrees in the logs of `logdir` (every service's logs
+    matching `pattern`), merging the files by timestamp so calls are
+    joined across services
+    """
+    index = TraceIndex(span, maxopen)
+    streams = [timed_records(logfile, **filters) for logfile in log_files(logdir, pattern)]
+    for dt, info in heapq.merge(*streams):
+        for tree in index.add(info):
+            yield tree
+    for tree in index.flush():
+        yield tree
@@ -0,0 +1,230 @@
+"""
+Interval statistics computed with NumPy.
+
+Lines are read into columnar PerfBatches (analyze.perf_batches: text
+lines are split straight into arrays of durations, epoch seconds and
+key codes, with no PerfInfo per line) and each batch is bucketed at
+once, with floor division of the epoch column and a stable sort on the
+bucket starts. Only the open intervals are held, as chunks of those
+arrays, so memory depends on the lines per interval rather than on the
+length of the logs, and intervals close, late lines included, as on the
+histogram path (analyze.groups). A closed interval becomes a
+KeyedHistograms of Samples (raw durations) with the same keys
+KeyedHistograms would have kept, so the partials of different files and
+workers merge as usual.
+
+Each merged interval is summarized at once: one sort orders the
+durations by key and value, after which counts, means, deviations and
+percentiles are array arithmetic over the key boundaries. Percentiles
+are exact (linearly interpolated at the same rank LatencyHistogram
+uses) rather than within the histogram's 1%.
+
+Parsing still dominates: on synthetic logs this runs about three to
+four times as fast as the histogram path, most of it in splitting the
+lines. analyze.yield_stats uses this given vectorize=True.
+"""
+from array import array
+from melk.util.dibject import Dibject as dibj
+from monkeytime.analyze import epoch_timestamp
+from monkeytime.analyze import open_log
+from monkeytime.analyze import perf_batches
+from monkeytime.histogram import KeyedHistograms
+import numpy
+
+
+class Samples(object):
+    """
+    Raw durations standing in for a LatencyHistogram in KeyedHistograms
+    (see its `factory`)
+    """
+
+    def __init__(self, accuracy=None):
+        self.values = array('d')
+
+    @classmethod
+    def from_array(cls, values):
+        samples = cls()
+        samples.values.fromstring(numpy.asarray(values, dtype=numpy.float64).tostring())
+        return samples
+
+    @property
+    def count(self):
+        return len(self.values)
+
+    def add(self, value):
+        self.values.append(value)
+
+    def merge(self, other):
+        self.values.extend(other.values)
+        return self
+
+    def __getstate__(self):
+        return self.values.tostring()
+
+    def __setstate__(self, state):
+        self.values = array('d')
+        self.values.fromstring(state)
+
+    def __repr__(self):
+        return "<%s count=%d>" % (self.__class__.__name__, self.count)
+
+
+def split_rows(starts):
+    """
+    (start, row indices in order) for each distinct value of `starts`
+    """
+    order = numpy.argsort(starts, kind='mergesort')
+    ordered = starts[order]
+    bounds = numpy.flatnonzero(ordered[1:] != ordered[:-1]) + 1
+    for rows in numpy.split(order, bounds):
+        yield starts[rows[0]], rows
+
+
+def space_saving(codes, names, top):
+    """
+    Replay KeyedHistograms' admissions and evictions over an interval's
+    key codes, in arrival order. Returns {code: (row, inherited)} for
+    the keys it ends up with: the row each was last admitted at (its
+    earlier rows went to OTHER) and the count it inherited then.
+    """
+    weights = {}
+    kept = {}
+    for row, code in enumerate(codes):
+        if code in weights:
+            weights[code] += 1
+            continue
+        inherited = 0
+        if len(weights) >= top:
+            inherited, name, victim = min((weight, names[key], key)
+                                          for key, weight in weights.iteritems())
+            del weights[victim]
+            del kept[victim]
+        weights[code] = inherited + 1
+        kept[code] = row, inherited
+    return kept
+
+
+def collect(chunks, top=None):
+    """
+    KeyedHistograms of Samples for an interval's (howlong, key, keys)
+    chunks, as KeyedHistograms(top) would hold the same lines added in
+    order
+    """
+    index = {}
+    values = numpy.concatenate([howlong for howlong, key, keys in chunks])
+    codes = numpy.concatenate([numpy.array([index.setdefault(name, len(index)) for name in keys],
+                                           dtype=numpy.intp)[key]
+                               for howlong, key, keys in chunks])
+    names = sorted(index, key=index.get)
+
+    hists = KeyedHistograms(top, factory=Samples)
+    if top and len(names) > top:
+        kept = space_saving(codes.tolist(), names, top)
+        admitted = numpy.repeat(len(codes), len(names))
+        for code, (row, inherited) in kept.iteritems():
+            admitted[code] = row
+            if inherited:
+                hists.errors[names[code]] = inherited
+        keep = numpy.arange(len(codes)) >= admitted[codes]
+        if not keep.all():
+            hists.hists[hists.OTHER] = Samples.from_array(values[~keep])
+        values, codes = values[keep], codes[keep]
+
+    order = numpy.argsort(codes, kind='mergesort')
+    counts = numpy.bincount(codes, minlength=len(names))
+    for code, chunk in enumerate(numpy.split(values[order], numpy.cumsum(counts)[:-1])):
+        if len(chunk):
+            hists.hists[names[code]] = Samples.from_array(chunk)
+    return hists
+
+
+def groups(batches, interval, top=None, reorder=5):
+    """
+    analyze.groups over PerfBatches: (KeyedHistograms of Samples,
+    start) as each `interval` second bucket closes, `reorder` seconds
+    past its end. Lines for a bucket that had already closed when they
+    were read make a fresh, partial one with the same start.
+    """
+    buckets = {}
+    latest = -numpy.inf
+    for batch in batches:
+        epoch = numpy.floor(numpy.frombuffer(batch.epoch, dtype=numpy.float64))
+        howlong = numpy.frombuffer(batch.howlong, dtype=numpy.float64)
+        key = numpy.frombuffer(batch.key, dtype=numpy.int32)
+        starts = epoch - epoch % interval
+
+        # the latest second read before each line
+        seen = numpy.maximum.accumulate(numpy.concatenate(([latest], epoch[:-1])))
+        late = starts + (interval + reorder) <= seen
+        if late.any():
+            for then, rows in split_rows(starts[late]):
+                chunk = (howlong[late][rows], key[late][rows], batch.keys)
+                yield collect([chunk], top), epoch_timestamp(then)
+            howlong, key, starts = howlong[~late], key[~late], starts[~late]
+
+        for then, rows in split_rows(starts):
+            buckets.setdefault(then, []).append((howlong[rows], key[rows], batch.keys))
+
+        latest = max(latest, epoch.max())
+        for then in sorted(x for x in buckets if x + interval + reorder <= latest):
+            yield collect(buckets.pop(then), top), epoch_timestamp(then)
+
+    # yield whatever is left
+    for then in sorted(buckets):
+        yield collect(buckets[then], top), epoch_timestamp(then)
+
+
+def iter_file_stats(logfile, interval, start=0, end=None, by=None, top=None, reorder=5,
+                    **filters):
+    """
+    analyze.iter_file_stats, bucketed from PerfBatches
+    """
+    print "File: %s" %logfile
+    batches = perf_batches(open_log(logfile, start, end), by=by, **filters)
+    for hists, then in groups(batches, interval, top, reorder):
+        if hists.count:
+            yield then, hists
+
+
+def interval_stats(hists, start, interval, by=None):
+    """
+    statdicts for each key of an interval's KeyedHistograms of Samples,
+    as analyze.interval_stats
+    """
+    items = [(key, samples) for key, samples in hists.items() if samples.count]
+    if not items:
+        return
+    counts = numpy.array([samples.count for key, samples in items])
+    values = numpy.concatenate([numpy.frombuffer(samples.values, dtype=numpy.float64)
+                                for key, samples in items])
+    codes = numpy.repeat(numpy.arange(len(items)), counts)
+    values = values[numpy.lexsort((values, codes))]
+
+    starts = numpy.cumsum(counts) - counts
+    means = numpy.add.reduceat(values, starts) / counts
+    deviations = values - numpy.repeat(means, counts)
+    squares = numpy.add.reduceat(deviations * deviations, starts)
+    stdevs = numpy.sqrt(numpy.where(counts > 1, squares / numpy.maximum(counts - 1, 1), 0.0))
+
+    def percentile(fraction):
+        rank = starts + fraction * (counts - 1)
+        low = numpy.floor(rank).astype(numpy.int64)
+        high = numpy.ceil(rank).astype(numpy.int64)
+        return values[low] + (values[high] - values[low]) * (rank - low)
+
+    columns = dict(min=values[starts] * 1000,
+                   max=values[starts + counts - 1] * 1000,
+                   mean=means * 1000,
+                   median=percentile(0.5) * 1000,
+                   p90th=percentile(0.9) * 1000,
+                   p98th=percentile(0.98) * 1000,
+                   p99th=percentile(0.99) * 1000,
+                   standard_deviation=stdevs * 1000)
+    columns = dict((name, column.tolist()) for name, column in columns.iteritems())
+    for seg, (key, samples) in enumerate(items):
+        info = dibj(interval=interval, start=start, howmany=samples.count)
+        for name, column in columns.iteritems():
+            info[name] = column[seg]
+        if by is not None:
+            info['key'] = key
+        yield info
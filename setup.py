@@ -16,11 +16,13 @@ setup(name='MonkeyTime',
       packages=find_packages(exclude=['ez_setup', 'examples', 'tests']),
       include_package_data=True,
       zip_safe=False,
-      install_requires=["statlib",
-                        "webob",
+      install_requires=["webob",
                         "melk.util"
                         ],
       entry_points="""
       # -*- Entry points: -*-
+      [console_scripts]
+      monkeytime-analyze = monkeytime.analyze:main
+      monkeytime-bench = monkeytime.bench:main
       """,
       )
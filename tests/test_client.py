@@ -0,0 +1,90 @@
+from SocketServer import ThreadingMixIn
+from monkeytime.client import TracedClient
+from monkeytime.instr import TraceProfile
+import BaseHTTPServer
+import threading
+import unittest
+
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def respond(self):
+        server = self.server
+        body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        server.requests.append((self.command, self.path, dict(self.headers), body))
+        self.send_response(200)
+        self.send_header('Content-Length', '2')
+        self.end_headers()
+        self.wfile.write('ok')
+        # drop the connection without saying so, like an idle timeout
+        self.close_connection = server.drop
+
+    do_GET = do_POST = respond
+
+    def log_message(self, *args):
+        pass
+
+
+class Server(ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+class TestTracedClient(unittest.TestCase):
+
+    def setUp(self):
+        self.server = Server(('127.0.0.1', 0), Handler)
+        self.server.requests = []
+        self.server.drop = False
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.url = 'http://127.0.0.1:%d' %self.server.server_port
+        self.client = TracedClient(logname=None)
+
+    def tearDown(self):
+        self.client.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_trace_headers(self):
+        with TraceProfile(logname=None) as parent:
+            resp = self.client.get(self.url + '/search?q=monkey')
+        self.assertEqual((resp.status, resp.body), (200, 'ok'))
+        method, target, headers, body = self.server.requests[0]
+        self.assertEqual(target, '/search?q=monkey')
+        origin, parent_uid, uid = headers['x-request-trace'].split(':')
+        self.assertEqual((origin, parent_uid), (parent.uid, parent.uid))
+        self.assertTrue(uid)
+        # the parent isn't logged, so neither is anything downstream
+        self.assertEqual(headers['x-ignore-request-trace'], 'true')
+
+    def test_pool_reuses_connections(self):
+        for x in range(3):
+            self.assertEqual(self.client.get(self.url + '/').status, 200)
+        stats = self.client.stats()
+        self.assertEqual(stats['pool']['misses'], 1)
+        self.assertEqual(stats['pool']['hits'], 2)
+        self.assertEqual(stats['phases']['ttfb']['count'], 3)
+
+    def test_stale_connection_get_is_retried(self):
+        self.server.drop = True
+        self.client.get(self.url + '/')
+        resp = self.client.get(self.url + '/')
+        self.assertEqual(resp.status, 200)
+        self.assertFalse(resp.reused)
+        self.assertEqual(len(self.server.requests), 2)
+
+    def test_stale_connection_post_is_not_resent(self):
+        self.server.drop = True
+        self.client.get(self.url + '/')
+        # the request was written before the failure showed, so the
+        # server may have acted on it
+        self.assertRaises(Exception, self.client.post, self.url + '/', 'body')
+        self.assertEqual(self.client.pool.stats()['idle'], 0)
+        self.assertEqual(self.client.post(self.url + '/', 'body').status, 200)
+        self.assertEqual([x[0] for x in self.server.requests], ['GET', 'POST'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,56 @@
+from monkeytime.index import SqliteIndex
+from path import path
+import shutil
+import tempfile
+import unittest
+
+# the first two requests share a uid (uids are only 24 bits)
+lines = ["1001 2011-05-03T00:00:01.000000 [instr.inbound] :aaaaaa:bbbbbb 0.250000 /caf\xc3\xa9 200\n",
+         "1002 2011-05-03T00:00:02.000000 [instr.inbound] :cccccc:bbbbbb 0.500000 /caf\xc3\xa9 200\n",
+         "1001 2011-05-03T00:00:03.000000 [instr.inbound] bbbbbb:bbbbbb:eeeeee 0.125000 /tea 200\n"]
+
+
+class TestSqliteIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = path(tempfile.mkdtemp(prefix='monkeytime-test'))
+        self.logdir = self.tmpdir / 'logs'
+        self.logdir.makedirs()
+        self.write(lines)
+        self.index = SqliteIndex(self.tmpdir / 'perf.index')
+
+    def tearDown(self):
+        self.index.close()
+        shutil.rmtree(self.tmpdir)
+
+    def write(self, lines):
+        with open(self.logdir / 'perf.log', 'a') as fh:
+            fh.write("".join(lines))
+
+    def test_requests_sharing_a_uid(self):
+        self.assertEqual(self.index.update(self.logdir), (3, 3))
+        rows = self.index.slowest("/caf\xc3\xa9")
+        self.assertEqual([(row['uid'], row['pid']) for row in rows],
+                         [('bbbbbb', '1002'), ('bbbbbb', '1001')])
+        self.assertEqual(rows[0]['uri'], "/caf\xc3\xa9")
+
+    def test_reload_only_reads_new_lines(self):
+        self.assertEqual(self.index.update(self.logdir), (3, 3))
+        self.assertEqual(self.index.update(self.logdir), (0, 0))
+        self.write(["1003 2011-05-03T00:00:04.000000 [instr.inbound] :ffffff:bbbbbb 1.000000 /tea 200\n"])
+        self.assertEqual(self.index.update(self.logdir), (1, 1))
+        self.assertEqual([row['howlong'] for row in self.index.slowest('/tea')], [1.0, 0.125])
+
+    def test_rows_already_stored_are_skipped(self):
+        self.index.update(self.logdir)
+        self.index.db.execute("delete from files")
+        self.assertEqual(self.index.update(self.logdir), (3, 0))
+
+    def test_children(self):
+        self.index.update(self.logdir)
+        rows = self.index.children('bbbbbb')
+        self.assertEqual([row['uid'] for row in rows], ['bbbbbb', 'bbbbbb', 'eeeeee'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,151 @@
+from monkeytime.instr import LatencyRecorder
+from monkeytime.instr import LeanTraceProfile
+from monkeytime.instr import PathMatcher
+from monkeytime.instr import TraceProfile
+from monkeytime.instr import TraceSampler
+import logging
+import threading
+import unittest
+
+
+class TestLatencyRecorder(unittest.TestCase):
+
+    def test_concurrent_record_and_snapshot(self):
+        # more paths than `top` keeps KeyedHistograms evicting
+        recorder = LatencyRecorder(period=60, top=50)
+        errors = []
+
+        def run(func, times):
+            try:
+                for i in xrange(times):
+                    func(i)
+            except Exception, e:
+                errors.append(e)
+
+        def record(i):
+            recorder.record('/path/%d' %(i % 500), 0.01)
+
+        threads = [threading.Thread(target=run, args=(record, 20000)) for x in range(4)]
+        threads.append(threading.Thread(target=run, args=(lambda i: recorder.snapshot(), 200)))
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(recorder.current.count, 80000)
+        self.assertTrue(len(recorder.snapshot()['current']['paths']) <= 51)
+
+
+class TestTraceHeaders(unittest.TestCase):
+
+    def outbound(self, sampled):
+        with TraceProfile(logname='test.trace', parents=('abc123', 'abc123', 'def456'),
+                          sampled=sampled) as prof:
+            return prof.prepare_outbound({})
+
+    def test_header_keeps_three_fields(self):
+        # services predating sampling split the header into exactly three
+        for sampled in True, False:
+            headers = self.outbound(sampled)
+            origin, parent, uid = headers[TraceProfile.HEADER].split(":")
+            self.assertEqual((origin, parent), ('abc123', 'def456'))
+
+    def test_sampling_travels_in_its_own_header(self):
+        sampler = TraceSampler(rate=0.0)
+        for sampled in True, False:
+            headers = self.outbound(sampled)
+            prof = TraceProfile.from_headers(headers, sampler=sampler)
+            self.assertEqual(prof.sampled, sampled)
+
+    def test_upstream_without_sampling(self):
+        headers = self.outbound(False)
+        del headers[TraceProfile.SAMPLED_HEADER]
+        prof = TraceProfile.from_headers(headers, sampler=TraceSampler(rate=0.0))
+        self.assertTrue(prof.sampled)
+
+
+class TestPathMatcher(unittest.TestCase):
+
+    def test_rules(self):
+        matcher = PathMatcher.from_config("""
+            /             exclude
+            /_status/**   exclude
+            /api/**       INFO
+            /api/*/raw    WARNING
+            /api/v1/raw   include
+        """)
+        self.assertEqual(matcher.match('/'), None)
+        self.assertEqual(matcher.match('/_status'), None)
+        self.assertEqual(matcher.match('/_status/health/deep'), None)
+        self.assertEqual(matcher.match('/api'), logging.INFO)
+        self.assertEqual(matcher.match('/api/v2/raw'), logging.WARNING)
+        self.assertEqual(matcher.match('/api/v1/raw'), logging.DEBUG)
+        self.assertEqual(matcher.match('/api/v1/cooked'), logging.INFO)
+        self.assertEqual(matcher.match('/other/thing'), logging.DEBUG)
+
+    def test_backtracks_from_literal_to_star(self):
+        matcher = PathMatcher([('/api/*/x', 'exclude'), ('/api/foo/y', 'INFO')])
+        self.assertEqual(matcher.match('/api/foo/x'), None)
+        self.assertEqual(matcher.match('/api/foo/y'), logging.INFO)
+        self.assertEqual(matcher.match('/api/foo/z'), logging.DEBUG)
+
+    def test_first_differing_segment_decides(self):
+        matcher = PathMatcher([('/a/*/c', 'exclude'), ('/a/b/**', 'INFO')])
+        self.assertEqual(matcher.match('/a/b/c'), logging.INFO)
+        self.assertEqual(matcher.match('/a/x/c'), None)
+
+    def test_end_beats_rest(self):
+        matcher = PathMatcher([('/a/**', 'exclude'), ('/a', 'INFO')])
+        self.assertEqual(matcher.match('/a'), logging.INFO)
+        self.assertEqual(matcher.match('/a/b'), None)
+
+    def test_blacklists(self):
+        matcher = PathMatcher.from_blacklists()
+        self.assertEqual(matcher.match('/'), None)
+        self.assertEqual(matcher.match('/js/app.js'), None)
+        self.assertEqual(matcher.match('/survey'), logging.DEBUG)
+
+
+class Records(logging.Handler):
+
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record)
+
+
+class TestImplicitParent(unittest.TestCase):
+
+    def setUp(self):
+        self.handler = Records()
+        self.logger = logging.getLogger('test.child')
+        self.logger.addHandler(self.handler)
+        self.logger.setLevel(logging.DEBUG)
+
+    def tearDown(self):
+        self.logger.removeHandler(self.handler)
+
+    def test_child_of_traced_request(self):
+        for profile in TraceProfile, LeanTraceProfile:
+            with profile(logname='test.parent') as parent:
+                with profile(logname='test.child') as child:
+                    headers = child.prepare_outbound({})
+            self.assertEqual(child.parent, parent.uid)
+            self.assertFalse(TraceProfile.IGNORE_HEADER in headers)
+        self.assertEqual(len(self.handler.records), 2)
+
+    def test_child_of_ignored_request(self):
+        # as logging_timer_mw makes for excluded paths or an ignore header
+        for profile in TraceProfile, LeanTraceProfile:
+            with profile(logname=None) as parent:
+                with profile(logname='test.child') as child:
+                    headers = child.prepare_outbound({})
+            self.assertEqual(child.parent, parent.uid)
+            self.assertEqual(headers[TraceProfile.IGNORE_HEADER], 'true')
+        self.assertEqual(self.handler.records, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,43 @@
+from monkeytime.rollup import RollupStore
+from path import path
+import shutil
+import tempfile
+import unittest
+
+lines = ["1001 2011-05-03T00:00:01.000000 [instr.inbound] :aaaaaa:bbbbbb 0.250000 /caf\xc3\xa9 200\n",
+         "1001 2011-05-03T00:00:02.000000 [instr.inbound] :cccccc:dddddd 0.500000 /tea 200\n"]
+
+
+class TestRollupStore(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = path(tempfile.mkdtemp(prefix='monkeytime-test'))
+        self.logdir = self.tmpdir / 'logs'
+        self.logdir.makedirs()
+        with open(self.logdir / 'perf.log', 'w') as fh:
+            fh.write("".join(lines))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def store(self, **kw):
+        store = RollupStore(self.tmpdir / 'perf.rollup', 60, **kw)
+        self.addCleanup(store.close)
+        return store
+
+    def test_non_ascii_head(self):
+        store = self.store()
+        self.assertEqual(store.update(self.logdir), 2)
+        self.assertEqual(store.update(self.logdir), 0)
+        rows = list(store.stats())
+        self.assertEqual([row.howmany for row in rows], [2])
+
+    def test_non_ascii_key(self):
+        store = self.store(by='uri')
+        self.assertEqual(store.update(self.logdir), 2)
+        rows = dict((row.key, row.howmany) for row in store.stats())
+        self.assertEqual(rows, {"/caf\xc3\xa9": 1, "/tea": 1})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,79 @@
+from monkeytime.shm import SharedHistograms
+import os
+import shutil
+import tempfile
+import unittest
+
+
+class TestSharedHistograms(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix='monkeytime-test')
+        self.region = SharedHistograms(os.path.join(self.tmpdir, 'region'), slots=8, routes=4)
+
+    def tearDown(self):
+        self.region.close()
+        shutil.rmtree(self.tmpdir)
+
+    def fork_workers(self, num, records, check=None):
+        """
+        fork `num` workers from the same region, released together so
+        that they race to claim slots, and kept alive (a dead worker's
+        slot is up for grabs) until `check` has run; returns their pids
+        """
+        gate, release = os.pipe()
+        done, recorded = os.pipe()
+        hold, finish = os.pipe()
+        pids = []
+        for x in range(num):
+            pid = os.fork()
+            if not pid:
+                status = 1
+                try:
+                    for fd in (release, done, finish):
+                        os.close(fd)
+                    os.read(gate, 1)
+                    for seconds in records:
+                        self.region.record('/search', seconds)
+                    os.write(recorded, 'x')
+                    os.read(hold, 1)
+                    status = 0
+                finally:
+                    os._exit(status)
+            pids.append(pid)
+        for fd in (gate, recorded, hold, release):
+            os.close(fd)
+        try:
+            for pid in pids:
+                self.assertEqual(os.read(done, 1), 'x')
+            if check is not None:
+                check(pids)
+        finally:
+            os.close(finish)
+            os.close(done)
+            for pid in pids:
+                self.assertEqual(os.waitpid(pid, 0)[1], 0)
+        return pids
+
+    def test_forked_workers_claim_distinct_slots(self):
+        records = [0.01, 0.02, 0.5]
+
+        def check(pids):
+            self.assertEqual(sorted(self.region.workers()), sorted(pids))
+            hist = self.region.snapshot().hists['/search']
+            self.assertEqual(hist.count, 4 * len(records))
+            self.assertEqual((hist.min, hist.max), (0.01, 0.5))
+
+        self.fork_workers(4, records, check)
+
+    def test_dead_worker_slot_is_reused(self):
+        first = self.fork_workers(1, [0.1])
+        second = self.fork_workers(1, [0.2])
+        claimed = [slot.pid for slot in self.region.slots if slot.pid]
+        self.assertEqual(claimed, second)
+        # the slot carries the dead worker's totals
+        self.assertEqual(self.region.snapshot().hists['/search'].count, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,128 @@
+from monkeytime.analyze import groups
+from monkeytime.analyze import info_batches
+from monkeytime.analyze import line_batches
+from monkeytime.analyze import line_keys
+from monkeytime.analyze import yield_stats
+from monkeytime.bench import synthetic_lines
+from monkeytime.bench import write_perf_logs
+import shutil
+import tempfile
+import unittest
+
+try:
+    import numpy
+    from monkeytime import vectorized
+except ImportError:
+    numpy = None
+
+
+@unittest.skipIf(numpy is None, "NumPy is not installed")
+class TestVectorizedStats(unittest.TestCase):
+    """
+    yield_stats with vectorize=True against the histogram path
+    """
+    exact = ('howmany', 'min', 'max')
+    close = ('mean', 'standard_deviation')
+    # histogram percentiles are within 1%, plus the gap to the next
+    # value the exact figure is interpolated towards, wider in the tail
+    estimated = dict(median=0.02, p90th=0.02, p98th=0.05, p99th=0.05)
+
+    @classmethod
+    def setUpClass(cls):
+        cls.logdir = write_perf_logs(tempfile.mkdtemp(prefix='monkeytime-test'), 60000,
+                                     uris=12, files=3)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.logdir)
+
+    def stats(self, **kw):
+        rows = {}
+        for info in yield_stats(self.logdir, "perf.log*", **kw):
+            rows[info.start, info.get('key')] = info
+        return rows
+
+    def compare(self, **kw):
+        hists = self.stats(vectorize=False, **kw)
+        arrays = self.stats(vectorize=True, **kw)
+        self.assertTrue(hists)
+        self.assertEqual(sorted(hists), sorted(arrays))
+        for row, expected in hists.iteritems():
+            got = arrays[row]
+            for name in self.exact:
+                self.assertEqual(got[name], expected[name], (row, name))
+            for name in self.close:
+                self.assertAlmostEqual(got[name], expected[name], 6, (row, name))
+            if expected.howmany < 1000:
+                # too few values for the gaps to be small
+                continue
+            for name, tolerance in self.estimated.iteritems():
+                self.assertTrue(abs(got[name] - expected[name]) <= tolerance * expected[name],
+                                (row, name, got[name], expected[name]))
+
+    def test_intervals(self):
+        self.compare(interval=300)
+
+    def test_by_uri(self):
+        self.compare(interval=300, by='uri')
+
+    def test_top_keys(self):
+        self.compare(interval=300, by='uri', top=5)
+
+    def test_workers(self):
+        self.compare(interval=300, by='uri', top=5, workers=2)
+
+
+@unittest.skipIf(numpy is None, "NumPy is not installed")
+class TestBatches(unittest.TestCase):
+    """
+    PerfBatches and the NumPy bucketing against analyze.groups
+    """
+
+    def setUp(self):
+        self.lines = list(synthetic_lines(5000, uris=30))
+
+    def columns(self, batches):
+        rows = []
+        for batch in batches:
+            rows.extend((howlong, epoch, batch.keys[code]) for howlong, epoch, code
+                        in zip(batch.howlong, batch.epoch, batch.key))
+        return rows
+
+    def test_lines_match_perf_info(self):
+        lines = self.lines[:100]
+        lines[10:10] = ["1000 2011-05-03T00:00:01.5 [instr.inbound] :1:2 0.5 /old\n",
+                        "garbage\n", "\n"]
+        for by in [None] + sorted(line_keys):
+            self.assertEqual(self.columns(line_batches(lines, size=7, by=by)),
+                             self.columns(info_batches(lines, size=7, by=by)), by)
+
+    def histograms(self, buckets):
+        merged = {}
+        for hists, start in buckets:
+            for key, hist in hists.hists.iteritems():
+                merged[start, key] = merged.get(start, 0) + hist.count
+        return merged
+
+    def test_top_keys_match_keyed_histograms(self):
+        expected = list(groups(self.lines, 10, by='uri', top=4))
+        got = list(vectorized.groups(line_batches(self.lines, size=37, by='uri'), 10, top=4))
+        self.assertEqual([start for hists, start in got], [start for hists, start in expected])
+        for (hists, start), (other, then) in zip(got, expected):
+            self.assertEqual(dict((key, x.count) for key, x in hists.hists.iteritems()),
+                             dict((key, x.count) for key, x in other.hists.iteritems()))
+            self.assertEqual(hists.errors, other.errors)
+
+    def test_late_lines(self):
+        lines = list(self.lines)
+        # every 250th line turns up about 20 seconds late
+        for pos in range(len(lines) - 2000, 0, -250):
+            lines.insert(pos + 2000, lines.pop(pos))
+        got = list(vectorized.groups(line_batches(lines, size=100, by='uri'), 10))
+        self.assertEqual(self.histograms(got), self.histograms(groups(lines, 10, by='uri')))
+        starts = [start for hists, start in got]
+        self.assertTrue(len(starts) > len(set(starts)))
+
+
+if __name__ == '__main__':
+    unittest.main()